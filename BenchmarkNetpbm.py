@@ -0,0 +1,223 @@
+#!/usr/env/python
+
+from __future__ import division, print_function
+
+## Import General Tools
+import sys
+import os
+import argparse
+import logging
+import json
+import time
+import tempfile
+import shutil
+import numpy as np
+import netpbmfile
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+##-------------------------------------------------------------------------
+## Synthetic Test Images
+##-------------------------------------------------------------------------
+## name: (magic number of ASCII version or None, depth, write as PAM)
+Formats = {"PBM": ("P1", 1, False),
+           "PGM": ("P2", 1, False),
+           "PPM": ("P3", 3, False),
+           "PAM": (None, 3, True),
+           }
+
+
+def MakeImage(width, height, depth, maxval):
+    '''Return a reproducible random image with values up to maxval.'''
+    random = np.random.RandomState(42)
+    shape = (height, width, depth) if depth > 1 else (height, width)
+    dtype = np.uint8 if maxval < 256 else np.uint16
+    return random.randint(0, maxval+1, size=shape).astype(dtype)
+
+
+def WriteASCII(filename, data, magicnum, maxval):
+    '''Write data as a plain (ASCII) PBM, PGM or PPM file.'''
+    height, width = data.shape[:2]
+    with open(filename, 'w') as fileFO:
+        if magicnum == "P1":
+            fileFO.write("P1\n{0} {1}\n".format(width, height))
+        else:
+            fileFO.write("{0}\n{1} {2}\n{3}\n".format(magicnum, width, height, maxval))
+        np.savetxt(fileFO, data.reshape(height, -1), fmt="%d")
+
+
+##-------------------------------------------------------------------------
+## Timing
+##-------------------------------------------------------------------------
+def Measure(function, repeat):
+    '''Call function repeat times and return the best time and peak memory.
+
+    Peak memory is the largest amount in MB traced by tracemalloc during a
+    call, or None if tracemalloc is not available.
+    '''
+    bestTime = None
+    peak = None
+    for i in range(repeat):
+        if tracemalloc:
+            tracemalloc.start()
+        startTime = time.time()
+        function()
+        elapsed = time.time() - startTime
+        if tracemalloc:
+            peak = max(peak or 0, tracemalloc.get_traced_memory()[1]/1024./1024.)
+            tracemalloc.stop()
+        bestTime = elapsed if bestTime is None else min(bestTime, elapsed)
+    return bestTime, peak
+
+
+def ReadHeader(filename):
+    '''Parse the header of filename the way NetpbmFile does.'''
+    with open(filename, 'rb') as fileFO:
+        netpbmfile.NetpbmFile(fileFO)
+
+
+def ReadRows(filename):
+    '''Read all rows of filename in strips.'''
+    netpbm = netpbmfile.NetpbmFile(filename)
+    try:
+        for strip in netpbm.iter_rows():
+            pass
+    finally:
+        netpbm.close()
+
+
+def ReadMapped(filename):
+    '''Map filename with imread and sum the image, so every page is read.'''
+    netpbmfile.imread(filename, mmap=True).sum()
+
+
+def ReadArray(filename, **kwargs):
+    '''Read filename using NetpbmFile.asarray with a cached copy.'''
+    netpbm = netpbmfile.NetpbmFile(filename)
+    try:
+        netpbm.asarray(cache=True, **kwargs)
+    finally:
+        netpbm.close()
+
+
+##-------------------------------------------------------------------------
+## Run Benchmarks for One Image
+##-------------------------------------------------------------------------
+def BenchmarkFile(name, encoding, bits, width, height, data, filename, repeat):
+    '''Return a list of benchmark records for one synthetic image file.'''
+    maxval = 1 if name == "PBM" else 2**bits - 1
+    pam = Formats[name][2]
+    operations = [("imread", lambda: netpbmfile.imread(filename)),
+                  ("asarray(copy=True)", lambda: ReadArray(filename, copy=True)),
+                  ("asarray(copy=False)", lambda: ReadArray(filename, copy=False)),
+                  ("header", lambda: ReadHeader(filename)),
+                  ]
+    if encoding == "binary":
+        operations += [("imsave", lambda: netpbmfile.imsave(filename, data, maxval=maxval, pam=pam)),
+                       ("imread(mmap=True)", lambda: ReadMapped(filename)),
+                       ("iter_rows", lambda: ReadRows(filename)),
+                       ]
+    size = os.path.getsize(filename)/1024./1024.
+    records = []
+    for operation, function in operations:
+        seconds, peak = Measure(function, repeat)
+        records.append({"format": name,
+                        "encoding": encoding,
+                        "bits": bits,
+                        "width": width,
+                        "height": height,
+                        "operation": operation,
+                        "file_MB": round(size, 3),
+                        "seconds": seconds,
+                        "MBps": size/seconds if seconds > 0 and operation != "header" else None,
+                        "peak_MB": peak,
+                        })
+    return records
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def main():
+
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    ## create a parser object for understanding command-line arguments
+    parser = argparse.ArgumentParser(
+             description="Benchmark netpbmfile read and write throughput on synthetic images.")
+    ## add flags
+    parser.add_argument("-v", "--verbose",
+        action="store_true", dest="verbose",
+        default=False, help="Be verbose! (default = False)")
+    parser.add_argument("--sizes",
+        type=str, dest="sizes",
+        default="640x427,2385x1589,4770x3178",
+        help="Comma separated list of image sizes as WIDTHxHEIGHT. (default = 640x427,2385x1589,4770x3178)")
+    parser.add_argument("--ascii-limit",
+        type=float, dest="asciilimit",
+        default=4e6, help="Skip ASCII files with more pixels than this. (default = 4e6)")
+    parser.add_argument("-r", "--repeat",
+        type=int, dest="repeat",
+        default=3, help="Number of times each operation is timed, the best time is reported. (default = 3)")
+    parser.add_argument("-o", "--output",
+        type=str, dest="output",
+        help="Write JSON lines results to this file. (default = stdout)")
+    args = parser.parse_args()
+
+    ##-------------------------------------------------------------------------
+    ## Create logger object
+    ##-------------------------------------------------------------------------
+    logger = logging.getLogger('MyLogger')
+    logger.setLevel(logging.DEBUG)
+    ## Set up console output
+    LogConsoleHandler = logging.StreamHandler()
+    if args.verbose:
+        LogConsoleHandler.setLevel(logging.DEBUG)
+    else:
+        LogConsoleHandler.setLevel(logging.INFO)
+    LogFormat = logging.Formatter('%(levelname)8s: %(message)s')
+    LogConsoleHandler.setFormatter(LogFormat)
+    logger.addHandler(LogConsoleHandler)
+
+    ##-------------------------------------------------------------------------
+    ## Generate images and run benchmarks
+    ##-------------------------------------------------------------------------
+    outputFO = open(args.output, 'w') if args.output else sys.stdout
+    benchDirectory = tempfile.mkdtemp()
+    try:
+        for size in args.sizes.split(","):
+            width, height = [int(n) for n in size.lower().split("x")]
+            for name in sorted(Formats.keys()):
+                asciiMagic, depth, pam = Formats[name]
+                for bits in ([1] if name == "PBM" else [8, 16]):
+                    maxval = 1 if name == "PBM" else 2**bits - 1
+                    data = MakeImage(width, height, depth, maxval)
+                    filename = os.path.join(benchDirectory, "bench.{0}".format(name.lower()))
+                    encodings = ["binary"]
+                    if asciiMagic and width*height <= args.asciilimit:
+                        encodings.append("ascii")
+                    for encoding in encodings:
+                        logger.info("Benchmarking {0} {1} {2}-bit {3}x{4}".format(\
+                                    encoding, name, bits, width, height))
+                        if encoding == "ascii":
+                            WriteASCII(filename, data, asciiMagic, maxval)
+                        else:
+                            netpbmfile.imsave(filename, data, maxval=maxval, pam=pam)
+                        for record in BenchmarkFile(name, encoding, bits, width, height,
+                                                    data, filename, args.repeat):
+                            logger.debug("  {0:20s} {1:8.3f} s".format(record["operation"], record["seconds"]))
+                            outputFO.write(json.dumps(record)+"\n")
+                        outputFO.flush()
+                        os.remove(filename)
+    finally:
+        shutil.rmtree(benchDirectory)
+        if args.output:
+            outputFO.close()
+
+
+if __name__ == '__main__':
+    main()
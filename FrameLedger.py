@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+FrameLedger.py
+
+On disk record of which frames have been analyzed, shared by Monitor.py and
+MeasureNight.py so that a restart only processes the frames it missed.
+"""
+
+from __future__ import division, print_function
+
+import os
+import time
+import sqlite3
+import threading
+
+
+DefaultLedgerFile = os.path.join("/home", "panoptesmlo", "IQMon", "Logs", "FrameLedger.sqlite")
+
+## skipped frames were not analyzed to keep up with a backlog, and are
+## processed again like pending ones
+States = ["pending", "running", "done", "failed", "skipped"]
+
+
+class FrameLedger(object):
+    '''SQLite table of frames keyed by path, size and modification time.
+
+    Each frame has a state (pending, running, done, failed or skipped), the
+    number of attempts, the times it was queued, started and finished, and a
+    message.  A frame whose size or modification time changed is treated as
+    a new frame.  The ledger may be shared by threads and by processes.
+    '''
+    def __init__(self, filename=DefaultLedgerFile):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS frames (
+                                       path TEXT PRIMARY KEY,
+                                       size INTEGER,
+                                       mtime REAL,
+                                       state TEXT,
+                                       attempts INTEGER,
+                                       queued REAL,
+                                       started REAL,
+                                       finished REAL,
+                                       message TEXT)''')
+
+    def Lookup(self, path):
+        '''Return the record for path as a dict, or None.'''
+        with self.lock:
+            row = self.connection.execute("SELECT * FROM frames WHERE path = ?",
+                                          (os.path.abspath(path), )).fetchone()
+        return dict(row) if row else None
+
+    def IsCurrent(self, record, path):
+        '''Return True if record describes the current version of path.'''
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return record['size'] == stat.st_size and record['mtime'] == stat.st_mtime
+
+    def NeedsProcessing(self, path, retryFailed=False):
+        '''Return True unless the current version of path is done.
+
+        Frames which failed are only processed again if retryFailed is True,
+        frames which were skipped always are.
+        '''
+        record = self.Lookup(path)
+        if not record or not self.IsCurrent(record, path):
+            return True
+        if record['state'] == "failed":
+            return retryFailed
+        return record['state'] != "done"
+
+    def SetState(self, path, state, message=None):
+        '''Record a new state for path and update its timings.'''
+        if state not in States:
+            raise ValueError("Unknown frame state: {}".format(state))
+        path = os.path.abspath(path)
+        now = time.time()
+        record = self.Lookup(path)
+        if not record or not self.IsCurrent(record, path):
+            try:
+                stat = os.stat(path)
+                size, mtime = stat.st_size, stat.st_mtime
+            except OSError:
+                size, mtime = None, None
+            record = {'path': path, 'size': size, 'mtime': mtime,
+                      'attempts': 0, 'queued': now, 'started': None,
+                      'finished': None, 'message': None}
+        record['state'] = state
+        record['message'] = message
+        if state == "pending":
+            record['queued'] = now
+        elif state == "running":
+            record['started'] = now
+            record['attempts'] += 1
+        else:
+            record['finished'] = now
+        with self.lock, self.connection:
+            self.connection.execute('''INSERT OR REPLACE INTO frames
+                                       (path, size, mtime, state, attempts, queued, started, finished, message)
+                                       VALUES (:path, :size, :mtime, :state, :attempts, :queued, :started, :finished, :message)''',
+                                    record)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -13,116 +13,118 @@ import sys
 import os
 from argparse import ArgumentParser
 import re
-import datetime
-import math
+import glob
 import time
+import calendar
 import subprocess
+import socket
+import signal
+import json
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
 
 import ephem
 import astropy.units as u
 import astropy.io.fits as fits
 
 import IQMon
+import raw2fits
+import SkycamInfo
+from StageMetrics import StageTimer
+from WCSCache import WCSCache, WCSCacheFileName, StarPositions
+from ResultsStore import ResultsStore, Fields
+
+CR2toFITSg = '/skycam/soft/CR2toFITSg'
+
+## Analysis modes, from the most to the least complete.  noplots skips the
+## PSF plot and the cropped jpeg, minimal also skips the astrometric solution
+## and pointing error.  Monitor.py uses the reduced modes to keep up with a
+## growing backlog.
+AnalysisModes = ["full", "noplots", "minimal"]
 
 
 ##-------------------------------------------------------------------------
-## Read Skycam Info
+## Add Header Cards to an Existing FITS File
 ##-------------------------------------------------------------------------
-def ReadSkycamInfo(RawFile, FitsFile):
-    if not os.path.exists(RawFile):
-        raise IOError("Unable to find input file: %s" % RawFile)
-    RawFileDirectory, RawFilename = os.path.split(RawFile)
-    RawBasename, RawExt = os.path.splitext(RawFilename)
-    NightDirectory = os.path.split(RawFileDirectory)[0]
-    DataNightString = os.path.split(os.path.split(RawFileDirectory)[0])[1]
-    InfoDirectory = os.path.join(NightDirectory, "CR2info")
-    InfoFile = os.path.join(InfoDirectory, RawBasename+".info")
-    try:
-        infoFO = open(InfoFile, 'r')
-        infolines = infoFO.read().split("\n")
-    except:
-        raise
+def AddHeaderCards(FitsFile, header):
+    '''Add the cards of header to the primary header of an existing FITS file.
 
+    Only needed for files written by the external CR2toFITSg program, as this
+    rewrites the file if its header grows.
+    '''
     hdulist = fits.open(FitsFile, mode='update', ignore_missing_end=True)
-    for line in infolines:
-        IsOBJECT = re.match("TARGETDESCRIPTION:\s*(\w+)", line)
-        if IsOBJECT: hdulist[0].header['OBJECT'] = IsOBJECT.group(1)
-        IsEXPTIME = re.match("SHUTTER:\s*(\d+\.?\d*)\ssec", line)
-        if IsEXPTIME: hdulist[0].header['EXPTIME'] = IsEXPTIME.group(1)
-        IsRA = re.match("RA:\s*(\d+\.?\d*)\sdeg", line)
-        if IsRA:
-            RAdecimalhours = float(IsRA.group(1))/15.
-            RAh = int(math.floor(RAdecimalhours))
-            RAm = int(math.floor((RAdecimalhours - RAh)*60.))
-            RAs = ((RAdecimalhours - RAh)*60. - RAm)*60.
-            hdulist[0].header['RA'] = "{:02d}:{:02d}:{:04.1f}".format(RAh, RAm, RAs)
-        IsDEC = re.match("DEC:\s*(\-?\d+\.?\d*)\sdeg", line)
-        if IsDEC:
-            DECdecimal = float(IsDEC.group(1))
-            DECd = int(math.floor(DECdecimal))
-            DECm = int(math.floor((DECdecimal - DECd)*60.))
-            DECs = ((DECdecimal - DECd)*60. - DECm)*60.
-            hdulist[0].header['DEC'] = "{:02d}:{:02d}:{:04.1f}".format(DECd, DECm, DECs)
-        IsUTSTART = re.match("UT_START:\s*(\d+\.?\d*)\shr", line)
-        if IsUTSTART:
-            UTdecimal = float(IsUTSTART.group(1))
-            UTh = int(math.floor(UTdecimal))
-            UTm = int(math.floor((UTdecimal - UTh)*60.))
-            UTs = ((UTdecimal - UTh)*60. - UTm)*60.
-            dateObs = "{}T{:02d}:{:02d}:{:04.1f}".format(DataNightString, UTh, UTm, UTs)
-            hdulist[0].header['DATE-OBS'] = dateObs
-    hdulist[0].header['LAT-OBS'] = 19.53602
-    hdulist[0].header['LONG-OBS'] = -155.57608
-    hdulist[0].header['ALT-OBS'] = 3400
+    hdulist[0].header.extend(header.cards, update=True)
     hdulist.flush()
     hdulist.close()
 
 
 ##-------------------------------------------------------------------------
-## Main Program
+## Convert CR2 to FITS (green channel only)
 ##-------------------------------------------------------------------------
-def main():
-    ##-------------------------------------------------------------------------
-    ## Parse Command Line Arguments
-    ##-------------------------------------------------------------------------
-    ## create a parser object for understanding command-line arguments
-    parser = ArgumentParser(description="Describe the script")
-    ## add flags
-    parser.add_argument("-v", "--verbose",
-        action="store_true", dest="verbose",
-        default=False, help="Be verbose! (default = False)")
-    parser.add_argument("-c", "--clobber",
-        action="store_true", dest="clobber",
-        default=False, help="Delete previous logs and summary files for this image. (default = False)")
-    ## add arguments
-    parser.add_argument("filename",
-        type=str,
-        help="File Name of Input Image File")
-    args = parser.parse_args()
-    
-    ##-------------------------------------------------------------------------
-    ## Deconstruct input filename in to path, filename and extension
-    ##-------------------------------------------------------------------------
-    RawFile = os.path.abspath(args.filename)
-    if not os.path.exists(RawFile):
-        raise IOError("Unable to find input file: %s" % RawFile)
-    RawFileDirectory, RawFilename = os.path.split(RawFile)
-    RawBasename, RawExt = os.path.splitext(RawFilename)
-    DataNightDirectory, DataNightString = os.path.split(os.path.split(RawFileDirectory)[0])
-    skycamJPEGfile = os.path.join(DataNightDirectory, DataNightString, "JPEG", RawFilename+'.jpeg')
+def ConvertCR2toFITS(image, external=False, header=None, ROI=None, solution=None):
+    '''Write the green channel of image.rawFile to image.workingFile.
 
-    ##-------------------------------------------------------------------------
-    ## Establish IQMon Configuration
-    ##-------------------------------------------------------------------------
-    config = IQMon.Config()
+    The conversion is done in-process using raw2fits unless external is True.
+    The external CR2toFITSg program is also used if the in-process conversion
+    fails.  The working file is never compressed, as IQMon, SExtractor and
+    solve-field read the image from the primary HDU.  The cards in header
+    are added to those read from the raw file, replacing any with the same
+    keyword.  If ROI is given, the in-process conversion crops the image to
+    it in memory before writing, the external program always writes the full
+    frame.  The cards of solution, an astrometric solution of the region
+    being written, are added as well unless the region written differs.
 
+    Returns True if the working file was cropped to ROI.  Raises IOError if
+    the conversion failed.
+    '''
+    if not external:
+        try:
+            cards = fits.Header()
+            if header is not None:
+                cards.extend(header.cards, update=True)
+            if solution is not None:
+                cards.extend(solution.cards, update=True)
+            raw2fits.WriteGreenFITS(image.rawFile, image.workingFile, image.logger,
+                                    header=cards, ROI=ROI)
+            return bool(ROI)
+        except:
+            image.logger.warning('  In-process conversion failed: {}'.format(sys.exc_info()[1]))
+            image.logger.warning('  Falling back to {}'.format(CR2toFITSg))
+    convertCommand = [CR2toFITSg, image.rawFile, image.workingFile]
+    image.logger.debug('  Running: {}'.format(repr(convertCommand)))
+    try:
+        subprocess.check_call(convertCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except:
+        image.logger.warning('  CR2toFITSg failed!')
+        raise IOError("Unable to convert {} to FITS".format(image.rawFile))
+    cards = fits.Header()
+    if header is not None:
+        cards.extend(header.cards, update=True)
+    ## The solution of a cropped region does not fit the full frame
+    if solution is not None and not ROI:
+        cards.extend(solution.cards, update=True)
+    if len(cards):
+        AddHeaderCards(image.workingFile, cards)
+    return False
 
-    ##-------------------------------------------------------------------------
-    ## Create Telescope Object
-    ##-------------------------------------------------------------------------
+
+##-------------------------------------------------------------------------
+## Create Telescope Object
+##-------------------------------------------------------------------------
+## Settings of each camera which differ from those of the original Panoptes
+## unit, as attribute: value pairs of the IQMon.Telescope object.  Cameras
+## which are not listed use the Panoptes settings under their own name.
+TelescopeProfiles = {
+                     "Panoptes": {},
+                     }
+
+
+def MakeTelescope(name="Panoptes"):
     tel = IQMon.Telescope()
-    tel.name = "Panoptes"
-    tel.longName = "Panoptes"
+    tel.name = name
+    tel.longName = name
     tel.focalLength = 85.*u.mm
     tel.pixelSize = 4.6*u.micron     ## Need to determine correct pixel size
     tel.aperture = 60.7*u.mm
@@ -146,13 +148,144 @@ def main():
     tel.measurement_radius = 1000
     ## Define Site (ephem site object)
     tel.site = ephem.Observer()
+    for attribute, value in TelescopeProfiles.get(name, {}).items():
+        setattr(tel, attribute, value)
     tel.CheckUnits()
     tel.DefinePixelScale()
+    return tel
+
+
+##-------------------------------------------------------------------------
+## Collect Results for the Results Store
+##-------------------------------------------------------------------------
+## IQMon.Image attribute holding each of the result Fields
+ResultAttributes = {
+                    "Alt": "targetAlt",
+                    "Az": "targetAz",
+                    "Airmass": "airmass",
+                    "MoonSep": "moonSep",
+                    "MoonIllum": "moonPhase",
+                    "FWHM": "FWHM",
+                    "ellipticity": "ellipticity",
+                    "Background": "SExtractorBackground",
+                    "PErr": "pointingError",
+                    "PosAng": "positionAngle",
+                    "nStars": "nStarsSEx",
+                    "ProcessTime": "processTime",
+                    }
+
+
+def ResultValues(image, header, RawFilename):
+    '''Return a dict of the result Fields of an analyzed image.
+
+    Values which IQMon did not determine, for example the pointing error
+    when astrometry was skipped, are left out.
+    '''
+    values = {"Date and Time": header.get('DATE-OBS'),
+              "Filename": RawFilename,
+              "Target": header.get('OBJECT'),
+              "ExpTime": header.get('EXPTIME')}
+    for field, attribute in ResultAttributes.items():
+        value = getattr(image, attribute, None)
+        if value is None:
+            continue
+        value = getattr(value, 'value', value)  ## Strip astropy units
+        try:
+            values[field] = float(value)
+        except:
+            values[field] = str(value)
+    return values
+
+
+##-------------------------------------------------------------------------
+## Run Independent Stages at the Same Time
+##-------------------------------------------------------------------------
+def RunConcurrently(stages, logger):
+    '''Call the functions of a list of (name, function) pairs at the same time.
+
+    The first function runs on the calling thread, so it may use pyplot,
+    which is not thread safe, and each of the others in a thread of its own.
+    An exception raised by a function is logged and does not stop the
+    others.  Waits for all of them and returns an OrderedDict of the seconds
+    each one took.
+    '''
+    times = {}
+    def Run(name, function):
+        startTime = time.time()
+        try:
+            function()
+        except:
+            logger.warning("Stage {} failed: {}".format(name, sys.exc_info()[1]))
+        times[name] = time.time() - startTime
+    threads = [threading.Thread(target=Run, args=stage) for stage in stages[1:]]
+    for thread in threads:
+        thread.start()
+    if stages:
+        Run(*stages[0])
+    for thread in threads:
+        thread.join()
+    return OrderedDict([(name, times[name]) for name, function in stages])
+
+
+##-------------------------------------------------------------------------
+## Process One Image
+##-------------------------------------------------------------------------
+def process(RawFile, tel=None, config=None, clobber=False, verbose=False,
+            external=False, mode="full", scratch=None,
+            crop=False, wcsCache=None, results=None, textLogs=True):
+    '''Analyze one CR2 image and record its results.
+
+    tel and config are created if not given.  A long lived worker passes in
+    the same objects for every image to avoid rebuilding them.  The time
+    taken by each stage is stored as a dict in image.stageTimes, together
+    with the time until the summary entry was written as "first_metric",
+    and the analysis mode (one of AnalysisModes) in image.analysisMode.
+
+    Temporary files are written to a directory of their own inside scratch
+    (config.pathTemp by default), which may be on a RAM backed file system.
+    It is removed when the image is done, even if the analysis fails or
+    SIGTERM is received, and the bytes written to it are stored in
+    image.bytesWritten.  Directories left by an earlier attempt at the same
+    image which was killed are removed first.  If crop is
+    True the image is cropped to tel.ROI before the working file is written.
+
+    If a WCSCache is given and it holds a solution for an earlier frame at
+    the same pointing, that solution is written to the working file instead
+    of solving the frame.  It is kept if the stars detected by SExtractor
+    match those of the earlier frame, otherwise the frame is solved.
+
+    If a ResultsStore is given, the results are added to it as soon as the
+    image quality is known, and clobber also hides the earlier rows of the
+    night in the store.  The HTML table and summary file are then rendered
+    from the store.  IQMon only writes its own if textLogs is True, under
+    names ending in _text.html and _text_Summary.txt.
+    '''
+    if mode not in AnalysisModes:
+        raise ValueError("Unknown analysis mode: {}".format(mode))
+    ##-------------------------------------------------------------------------
+    ## Deconstruct input filename in to path, filename and extension
+    ##-------------------------------------------------------------------------
+    RawFile = os.path.abspath(RawFile)
+    if not os.path.exists(RawFile):
+        raise IOError("Unable to find input file: %s" % RawFile)
+    RawFileDirectory, RawFilename = os.path.split(RawFile)
+    RawBasename, RawExt = os.path.splitext(RawFilename)
+    DataNightDirectory, DataNightString = os.path.split(os.path.split(RawFileDirectory)[0])
+    skycamJPEGfile = os.path.join(DataNightDirectory, DataNightString, "JPEG", RawFilename+'.jpeg')
+
+    ##-------------------------------------------------------------------------
+    ## Establish IQMon Configuration and Telescope Object
+    ##-------------------------------------------------------------------------
+    if config is None:
+        config = IQMon.Config()
+    if tel is None:
+        tel = MakeTelescope()
 
     ##-------------------------------------------------------------------------
     ## Create IQMon.Image Object
     ##-------------------------------------------------------------------------
     image = IQMon.Image(RawFile, tel, config)  ## Create image object
+    image.analysisMode = mode
 
     ##-------------------------------------------------------------------------
     ## Create Filenames
@@ -160,61 +293,297 @@ def main():
     IQMonLogFileName = os.path.join(config.pathLog, DataNightString+"_"+tel.name+"_IQMonLog.txt")
     htmlImageList = os.path.join(config.pathLog, DataNightString+"_"+tel.name+".html")
     summaryFile = os.path.join(config.pathLog, DataNightString+"_"+tel.name+"_Summary.txt")
+    ## With a results store those files are rendered from it, so the text
+    ## logs IQMon writes itself get names of their own
+    textHtmlList, textSummaryFile = htmlImageList, summaryFile
+    if results is not None:
+        textHtmlList = os.path.join(config.pathLog, DataNightString+"_"+tel.name+"_text.html")
+        textSummaryFile = os.path.join(config.pathLog, DataNightString+"_"+tel.name+"_text_Summary.txt")
     FullFrameJPEG = os.path.join(DataNightString, image.rawFileBasename+"_full.jpg")
     CropFrameJPEG = os.path.join(DataNightString, image.rawFileBasename+"_crop.jpg")
     BackgroundJPEG = os.path.join(DataNightString, image.rawFileBasename+"_bkgnd.jpg")
     PSFplotfile = os.path.join(DataNightString, image.rawFileBasename+"_PSF.png")
     if not os.path.exists(os.path.join(config.pathPlots, DataNightString)):
         os.mkdir(os.path.join(config.pathPlots, DataNightString))
-    if args.clobber:
-        if os.path.exists(IQMonLogFileName): os.remove(IQMonLogFileName)
-        if os.path.exists(htmlImageList): os.remove(htmlImageList)
-        if os.path.exists(summaryFile): os.remove(summaryFile)
+    if clobber:
+        for File in set([IQMonLogFileName, htmlImageList, summaryFile, textHtmlList, textSummaryFile]):
+            if os.path.exists(File): os.remove(File)
+        if results is not None:
+            results.Clobber(tel.name, DataNightString)
 
 
     ##-------------------------------------------------------------------------
     ## Perform Actual Image Analysis
     ##-------------------------------------------------------------------------
-    image.MakeLogger(IQMonLogFileName, args.verbose)
-    image.logger.info("###### Processing Image:  %s ######", RawFilename)
-
-    image.logger.info("Converting from CR2 to FITS (green channel only).")
-    image.workingFile = os.path.join(config.pathTemp, image.rawFileBasename+'.fits')
-    if os.path.exists(image.workingFile): os.remove(image.workingFile)
-    convertCommand = '/skycam/soft/CR2toFITSg '+image.rawFile+' '+image.workingFile
-    image.logger.debug('  Running: {}'.format(convertCommand))
+    image.MakeLogger(IQMonLogFileName, verbose)
+    pathTemp = config.pathTemp
+    ## Remove directories left by earlier attempts at this frame which were
+    ## killed before they could clean up
+    for stale in glob.glob(os.path.join(scratch or pathTemp, RawBasename+"_*")):
+        if os.path.isdir(stale):
+            shutil.rmtree(stale, ignore_errors=True)
+    ScratchDirectory = tempfile.mkdtemp(prefix=RawBasename+"_", dir=scratch or pathTemp)
+    config.pathTemp = ScratchDirectory
+    timer = StageTimer(directory=ScratchDirectory)
+    image.stageTimes = timer.stages
+    image.bytesWritten = 0
     try:
-        result = subprocess.check_call(convertCommand, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    except:
-        image.logger.warning('  CR2toFITSg failed!')
+        image.logger.info("###### Processing Image:  %s ######", RawFilename)
+        if mode != "full":
+            image.logger.info("Analysis mode: %s", mode)
+
+        image.logger.info("Reading info file created by skycam.c")
+        header = SkycamInfo.SkycamHeader(RawFile)
+        info = SkycamInfo.ReadInfo(RawFile)
+        obstime = None
+        if wcsCache and info.utstart is not None:
+            try:
+                obstime = calendar.timegm(time.strptime(DataNightString, "%Y-%m-%d")) + info.utstart*3600.
+            except ValueError:
+                image.logger.warning("Night {} is not a date, not using the astrometry cache".format(DataNightString))
+        region = tel.ROI if crop else "full"
+        cached = None
+        if wcsCache and mode != "minimal":
+            cached = wcsCache.Lookup(tel.name, region, info.target, info.ra, info.dec, obstime)
+        if cached:
+            image.logger.info("Using the astrometric solution of an earlier frame at this pointing")
+        timer.Mark("read_info")
+
+        image.logger.info("Converting from CR2 to FITS (green channel only).")
+        image.workingFile = os.path.join(config.pathTemp, image.rawFileBasename+'.fits')
+        if os.path.exists(image.workingFile): os.remove(image.workingFile)
+        cropped = ConvertCR2toFITS(image, external=external, header=header,
+                                   ROI=tel.ROI if crop else None,
+                                   solution=cached[0] if cached else None)
+        if crop and not cropped:
+            ## The external converter wrote the full frame
+            region = "full"
+            if cached:
+                image.logger.info("Working file is not cropped, not using the earlier solution")
+                cached = None
+        image.tempFiles.append(image.workingFile)
+        image.fileExt = os.path.splitext(image.workingFile)[1]
+        image.GetHeader()           ## Extract values from header
+        timer.Mark("convert")
+
+        image.logger.info("Creating full frame jpeg symlink to {}".format(skycamJPEGfile))
+        image.jpegFileNames = [FullFrameJPEG]
+        if os.path.exists(skycamJPEGfile) and not os.path.exists(os.path.join(config.pathPlots, FullFrameJPEG)):
+            image.logger.info("Creating symlink to skycam.c jpeg.")
+            os.symlink(skycamJPEGfile, os.path.join(config.pathPlots, FullFrameJPEG))
+        timer.Mark("jpeg_link")
+
+        if (mode == "full" or mode == "noplots") and not cached:
+            image.SolveAstrometry()         ## Solve Astrometry
+            image.GetHeader()               ## Extract values from header
+            timer.Mark("astrometry")
+#         image.Crop()                    ## Crop Image
+#         image.GetHeader()               ## Extract values from header
+        image.RunSExtractor()           ## Run SExtractor
+        timer.Mark("sextractor")
+        if mode == "full" or mode == "noplots":
+            stars = StarPositions(getattr(image, 'SExtractorResults', None))
+            if cached and not wcsCache.Verify(stars, cached):
+                image.logger.info("Stars do not match the earlier frame, solving astrometry")
+                cached = None
+                image.SolveAstrometry()     ## Solve Astrometry
+                image.GetHeader()           ## Extract values from header
+                timer.Mark("astrometry")
+            if wcsCache and not cached:
+                try:
+                    wcsCache.Store(tel.name, region, info.target, info.ra, info.dec, obstime,
+                                   image.workingFile, stars)
+                except:
+                    image.logger.warning("Could not cache astrometric solution: {}".format(sys.exc_info()[1]))
+            image.DeterminePointingError()  ## Calculate Pointing Error
+            timer.Mark("pointing")
+        image.DetermineFWHM()           ## Determine FWHM from SExtractor results
+        timer.Mark("fwhm")
+        ## The image quality is known now, publish it before rendering
+        image.CalculateProcessTime()    ## Calculate how long it took to process this image
+        if results is not None:
+            links = [os.path.join(config.pathPlots, FullFrameJPEG)]
+            if mode == "full":
+                links += [os.path.join(config.pathPlots, CropFrameJPEG),
+                          os.path.join(config.pathPlots, PSFplotfile)]
+            results.Add(tel.name, DataNightString, ResultValues(image, header, RawFilename),
+                        mode=mode, links=links)
+        if textLogs or results is None:
+            image.AddSummaryEntry(textSummaryFile)  ## Add line for this image to text table
+        timer.Mark("summary")
+        timer.Milestone("first_metric")
+        if mode == "full":
+            ## The PSF plot and the jpeg only read the image and the SExtractor
+            ## results, so they are rendered at the same time.  The results are
+            ## already published, so a failed plot does not fail the frame.
+            timer.stages.update(RunConcurrently([
+                ("psf_plot", lambda: image.MakePSFplot(plotFileName=PSFplotfile)),
+                ("jpeg", lambda: image.MakeJPEG(CropFrameJPEG, markDetectedStars=True, markPointing=True, binning=1)),
+                ], image.logger))
+            timer.Mark("render")
+        image.CleanUp()                 ## Cleanup (delete) temporary files.
+        timer.Mark("cleanup")
+        ## The HTML table links to the rendered plots, so it is written last
+        if textLogs or results is None:
+            image.AddWebLogEntry(textHtmlList, fields=Fields) ## Add line for this image to HTML table
+        timer.Mark("report")
+        image.bytesWritten = timer.BytesWritten()
+        image.logger.info("Wrote {:.1f} MB of temporary files".format(image.bytesWritten/1024./1024.))
+    finally:
+        config.pathTemp = pathTemp
+        shutil.rmtree(ScratchDirectory, ignore_errors=True)
+        ## Detach the log handlers, so a long lived worker does not
+        ## accumulate one set of handlers per image.
+        for handler in list(image.logger.handlers):
+            image.logger.removeHandler(handler)
+            handler.close()
+    return image
+
+
+##-------------------------------------------------------------------------
+## Serve Images Sent over a Socket
+##-------------------------------------------------------------------------
+def Serve(SocketPath, verbose=False, external=False, telescope="Panoptes",
+          scratch=None, crop=False, wcsCache=None, results=None, textLogs=True,
+          config=None):
+    '''Process images sent to a Unix domain socket at SocketPath.
+
+    The telescope and configuration objects are created once and reused, so
+    each image avoids the startup cost of a new MeasureImage.py process.
+    Each connection sends one JSON line with the "filename" and optionally
+    "clobber", "telescope" (default telescope) and "mode", and receives one
+    JSON line with the "status" and the processing time in "seconds" and of
+    each stage in "stages".  A request which cannot be read is answered with
+    a failed status, and the worker goes on serving.
+    '''
+    if config is None:
+        config = IQMon.Config()
+    telescopes = {}
+    if os.path.exists(SocketPath): os.remove(SocketPath)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(SocketPath)
+    server.listen(1)
+    try:
+        while True:
+            connection = server.accept()[0]
+            try:
+                startTime = time.time()
+                stages = {}
+                try:
+                    request = json.loads(connection.makefile('r').readline())
+                    name = request.get('telescope', telescope)
+                    if name not in telescopes:
+                        telescopes[name] = MakeTelescope(name)
+                    image = process(request['filename'], tel=telescopes[name], config=config,
+                                    clobber=request.get('clobber', False), verbose=verbose,
+                                    external=external,
+                                    mode=request.get('mode', "full"),
+                                    scratch=scratch, crop=crop, wcsCache=wcsCache,
+                                    results=results, textLogs=textLogs)
+                    stages = image.stageTimes
+                    status = "ok"
+                except Exception as e:
+                    status = "failed: {}".format(e)
+                reply = {"status": status, "seconds": time.time() - startTime, "stages": stages}
+                try:
+                    connection.sendall((json.dumps(reply)+"\n").encode('utf-8'))
+                except socket.error:
+                    pass    ## The client gave up waiting
+            finally:
+                connection.close()
+    finally:
+        server.close()
+        os.remove(SocketPath)
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def Terminate(signum, frame):
+    '''Turn SIGTERM into an exception, so the scratch directory is removed.'''
+    raise SystemExit("Terminated by signal {}".format(signum))
+
+
+def main():
+    ##-------------------------------------------------------------------------
+    ## Parse Command Line Arguments
+    ##-------------------------------------------------------------------------
+    ## create a parser object for understanding command-line arguments
+    parser = ArgumentParser(description="Describe the script")
+    ## add flags
+    parser.add_argument("-v", "--verbose",
+        action="store_true", dest="verbose",
+        default=False, help="Be verbose! (default = False)")
+    parser.add_argument("-c", "--clobber",
+        action="store_true", dest="clobber",
+        default=False, help="Delete previous logs and summary files for this night, and hide its earlier results. (default = False)")
+    parser.add_argument("--cr2tofitsg",
+        action="store_true", dest="cr2tofitsg",
+        default=False, help="Convert using the external CR2toFITSg program instead of raw2fits. (default = False)")
+    parser.add_argument("--telescope",
+        type=str, dest="telescope",
+        default="Panoptes", help="Name of the camera which took the image, selects its settings and log files. (default = Panoptes)")
+    parser.add_argument("--mode",
+        type=str, dest="mode", choices=AnalysisModes,
+        default="full", help="Analysis mode: full, noplots (no PSF plot or jpeg) or minimal (also no astrometry). (default = full)")
+    parser.add_argument("--scratch",
+        type=str, dest="scratch",
+        default=None, help="Directory for temporary files, e.g. a tmpfs such as /dev/shm. (default = IQMon temporary directory)")
+    parser.add_argument("--crop",
+        action="store_true", dest="crop",
+        default=False, help="Crop the image to the telescope ROI in memory before writing the working file. (default = False)")
+    parser.add_argument("--wcs-cache",
+        type=str, dest="wcscache",
+        default=None, help="SQLite file of astrometric solutions reused for frames at the same pointing. (default = {} in the IQMon log directory)".format(WCSCacheFileName))
+    parser.add_argument("--no-wcs-cache",
+        action="store_true", dest="nowcscache",
+        default=False, help="Solve the astrometry of every frame. (default = False)")
+    parser.add_argument("--results",
+        type=str, dest="results",
+        default=None, help="SQLite file the results of each image are added to, for the caller to render the HTML table and summary file from.  Without it IQMon writes them itself. (default = None)")
+    parser.add_argument("--text-logs",
+        action="store_true", dest="textlogs",
+        default=False, help="Also have IQMon append to its own HTML table and summary file, <night>_<telescope>_text.html and _text_Summary.txt. (default = False)")
+    parser.add_argument("--serve",
+        type=str, dest="serve",
+        default=None, help="Run as a long lived worker, processing images sent to this Unix socket. (default = None)")
+    ## add arguments
+    parser.add_argument("filename",
+        type=str, nargs="?",
+        help="File Name of Input Image File")
+    args = parser.parse_args()
+    if not args.filename and not args.serve:
+        parser.error("a filename is required unless --serve is used")
+    signal.signal(signal.SIGTERM, Terminate)
+
+    config = IQMon.Config()
+    wcsCache = None
+    if not args.nowcscache:
+        wcsCache = WCSCache(args.wcscache or os.path.join(config.pathLog, WCSCacheFileName))
+
+    results = None
+    if args.results:
+        results = ResultsStore(args.results)
+
+    if args.serve:
+        Serve(args.serve, verbose=args.verbose, external=args.cr2tofitsg,
+              telescope=args.telescope,
+              scratch=args.scratch, crop=args.crop, wcsCache=wcsCache,
+              results=results, textLogs=args.textlogs, config=config)
+        return
+
+    try:
+        image = process(args.filename, tel=MakeTelescope(args.telescope), config=config,
+                        clobber=args.clobber, verbose=args.verbose,
+                        external=args.cr2tofitsg,
+                        mode=args.mode, scratch=args.scratch, crop=args.crop,
+                        wcsCache=wcsCache, results=results, textLogs=args.textlogs)
+    except IOError as e:
+        print(e)
         sys.exit(1)
-    image.tempFiles.append(image.workingFile)
-    image.fileExt = os.path.splitext(image.workingFile)[1]
-    
-    image.logger.info("Reading info file created by skycam.c")
-    ReadSkycamInfo(RawFile, image.workingFile)
-    image.GetHeader()           ## Extract values from header
-
-    image.logger.info("Creating full frame jpeg symlink to {}".format(skycamJPEGfile))
-    image.jpegFileNames = [FullFrameJPEG]
-    if os.path.exists(skycamJPEGfile) and not os.path.exists(os.path.join(config.pathPlots, FullFrameJPEG)):
-        image.logger.info("Creating symlink to skycam.c jpeg.")
-        os.symlink(skycamJPEGfile, os.path.join(config.pathPlots, FullFrameJPEG))
-
-    image.SolveAstrometry()         ## Solve Astrometry
-    image.GetHeader()               ## Extract values from header
-    image.DeterminePointingError()  ## Calculate Pointing Error
-#     image.Crop()                    ## Crop Image
-#     image.GetHeader()               ## Extract values from header
-    image.RunSExtractor()           ## Run SExtractor
-    image.DetermineFWHM()           ## Determine FWHM from SExtractor results
-    image.MakePSFplot(plotFileName=PSFplotfile)
-    image.MakeJPEG(CropFrameJPEG, markDetectedStars=True, markPointing=True, binning=1)
-    image.CleanUp()                 ## Cleanup (delete) temporary files.
-    image.CalculateProcessTime()    ## Calculate how long it took to process this image
-    fields=["Date and Time", "Filename", "Target", "ExpTime", "Alt", "Az", "Airmass", "MoonSep", "MoonIllum", "FWHM", "ellipticity", "Background", "PErr", "PosAng", "nStars", "ProcessTime"]
-    image.AddWebLogEntry(htmlImageList, fields=fields) ## Add line for this image to HTML table
-    image.AddSummaryEntry(summaryFile)  ## Add line for this image to text table
+    ## Read by Monitor.py
+    print("Stage times: {}".format(json.dumps(image.stageTimes)))
+    print("Bytes written: {}".format(image.bytesWritten))
     
 
 if __name__ == '__main__':
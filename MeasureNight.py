@@ -7,6 +7,8 @@ Created by Josh Walawender on 2012-10-29.
 Copyright (c) 2012 . All rights reserved.
 """
 
+from __future__ import division, print_function
+
 import sys
 import os
 import subprocess
@@ -17,30 +19,15 @@ import time
 from argparse import ArgumentParser
 
 import IQMon
+from FrameLedger import FrameLedger, DefaultLedgerFile
+import SkycamInfo
+from ResultsStore import ResultsStore, NightRenderer, ResultsFileName
 
 help_message = '''
 The help message goes here.
 '''
 
 
-def GetImtype(imageFile):
-    RawFile = os.path.abspath(imageFile)
-    RawFileDirectory, RawFilename = os.path.split(RawFile)
-    RawBasename, RawExt = os.path.splitext(RawFilename)
-    DataNightDirectory, DataNightString = os.path.split(os.path.split(RawFileDirectory)[0])
-    infoFile = os.path.join(DataNightDirectory, DataNightString, "CR2info", RawBasename+'.info')
-    infoFO = open(infoFile, 'r')
-    info = infoFO.read()
-    lines = info.split("\n")
-    infoFO.close()
-    imtype = None
-    for line in lines:
-        IsMatch = re.match("IMTYPE:\s+(\w+)", line)
-        if IsMatch:
-            imtype = IsMatch.group(1)
-    return imtype
-
-
 def main(argv=None):  
     ##-------------------------------------------------------------------------
     ## Parse Command Line Arguments
@@ -55,7 +42,19 @@ def main(argv=None):
     parser.add_argument("-d", "--date", 
         dest="date", required=False, default="", type=str,
         help="UT date of night to analyze. (i.e. '2013-08-05')")
+    parser.add_argument("--ledger",
+        dest="ledger", required=False, default=DefaultLedgerFile, type=str,
+        help="SQLite file recording which frames have been processed. (default = %s)" % DefaultLedgerFile)
+    parser.add_argument("--retry-failed",
+        dest="retryfailed", action="store_true", default=False,
+        help="Process frames which failed in an earlier run again. (default = False)")
+    parser.add_argument("--results",
+        dest="results", required=False, default=None, type=str,
+        help="SQLite file MeasureImage.py adds the results of each frame to. (default = %s in the IQMon log directory)" % ResultsFileName)
     args = parser.parse_args()
+    config = IQMon.Config()
+    if not args.results:
+        args.results = os.path.join(config.pathLog, ResultsFileName)
     
     
     ##-------------------------------------------------------------------------
@@ -70,15 +69,18 @@ def main(argv=None):
     DataPath = os.path.join("/skycamdata")
     ImagesDirectory = os.path.join(DataPath, args.date, "CR2")
     
-    print "Analyzing data for night of "+args.date
+    print("Analyzing data for night of "+args.date)
     if os.path.exists(ImagesDirectory):
-        print "  Found "+ImagesDirectory
+        print("  Found "+ImagesDirectory)
         ##
         ## Loop Through All Images in Images Directory
         ##
         Files = sorted(os.listdir(ImagesDirectory))
-        print "Found %d files in images directory" % len(Files)
+        print("Found %d files in images directory" % len(Files))
         if len(Files) >= 1:
+            ## Image types from the index of the night's info files
+            index = SkycamInfo.NightIndex(os.path.join(DataPath, args.date, "CR2info")).Update()
+            Objects = set(index.Select("OBJECT"))
             ## Parse filename for date and time
             MatchFilename = re.compile("IMG0_(\d{4})\.CR2")
             Properties = []
@@ -86,34 +88,53 @@ def main(argv=None):
                 IsMatch = MatchFilename.match(File)
                 if IsMatch:
                     filenumber = IsMatch.group(1)
-                    imtype = GetImtype(os.path.join(ImagesDirectory, File))
-                    if imtype and imtype == "OBJECT":
+                    if os.path.splitext(File)[0]+".info" in Objects:
                         Properties.append([filenumber, File])
 
             SortedImageFiles   = numpy.array([row[1] for row in sorted(Properties)])
         
-            print "%d out of %d files meet selection criteria." % (len(SortedImageFiles), len(Files))
+            print("%d out of %d files meet selection criteria." % (len(SortedImageFiles), len(Files)))
+
+            ## Skip frames the ledger records as already processed
+            ledger = FrameLedger(args.ledger)
+            nSelected = len(SortedImageFiles)
+            SortedImageFiles = numpy.array([Image for Image in SortedImageFiles\
+                               if ledger.NeedsProcessing(os.path.join(ImagesDirectory, Image), retryFailed=args.retryfailed)])
+            print("%d of these have not been processed yet." % len(SortedImageFiles))
+            if args.clobber and len(SortedImageFiles) < nSelected:
+                print("Not clobbering logs, they hold results of frames processed earlier.")
+                args.clobber = False
             for Image in SortedImageFiles:
                 if fnmatch.fnmatch(Image, "*.CR2"):
                     now = time.gmtime()
                     TimeString = time.strftime("%Y/%m/%d %H:%M:%S UT -", now)
                     DateString = time.strftime("%Y%m%dUT", now)
 
-                    ProcessCall = ["/home/panoptesmlo/bin/Panoptes/MeasureImage.py"]
+                    ProcessCall = ["/home/panoptesmlo/bin/Panoptes/MeasureImage.py", "--results", args.results]
                     if args.clobber and Image == SortedImageFiles[0]:
                         ProcessCall.append("--clobber")
                     ProcessCall.append(os.path.join(ImagesDirectory, Image))
-                    print "%s Calling MeasureImage.py with %s" % (TimeString, ProcessCall)
+                    print("%s Calling MeasureImage.py with %s" % (TimeString, ProcessCall))
+                    ledger.SetState(os.path.join(ImagesDirectory, Image), "running")
                     try:
-                        MIoutput = subprocess.check_output(ProcessCall, stderr=subprocess.STDOUT)
+                        MIoutput = subprocess.check_output(ProcessCall, stderr=subprocess.STDOUT,
+                                                           universal_newlines=True)
                         for line in MIoutput.split("\n"):
-                            print line
+                            print(line)
+                        ledger.SetState(os.path.join(ImagesDirectory, Image), "done")
                     except:
-                        print "Call to MeasureImage.py Failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2])
+                        print("Call to MeasureImage.py Failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
+                        ledger.SetState(os.path.join(ImagesDirectory, Image), "failed", str(sys.exc_info()[1]))
+            ledger.close()
+            ## Render the HTML table and summary file from the results
+            results = ResultsStore(args.results)
+            nRows = NightRenderer(results, "Panoptes", args.date, config.pathLog).Render()
+            print("Rendered %d results for %s" % (nRows, args.date))
+            results.close()
         else:
-            print "No image files found in directory: "+ImagesDirectory
+            print("No image files found in directory: "+ImagesDirectory)
     else:
-        print "No Images or Logs directory for this night"
+        print("No Images or Logs directory for this night")
 
 if __name__ == "__main__":
     sys.exit(main())
@@ -1,13 +1,13 @@
-#!/usr/bin/env python
+#!/usr/bin/env python3
 # encoding: utf-8
 """
 Monitor.py
 
 Created by Josh Walawender on 2013-07-25.
 Copyright (c) 2013 __MyCompanyName__. All rights reserved.
-"""
 
-from __future__ import division, print_function
+Requires Python 3.  MeasureImage.py is run with the same interpreter.
+"""
 
 import sys
 import os
@@ -15,6 +15,21 @@ from argparse import ArgumentParser
 import re
 import time
 import subprocess
+import select
+import signal
+import threading
+import socket
+import json
+import tempfile
+import struct
+import ctypes
+import ctypes.util
+from collections import OrderedDict
+
+from FrameLedger import FrameLedger, DefaultLedgerFile
+from StageMetrics import StageMetrics
+import SkycamInfo
+from ResultsStore import ResultsStore, NightRenderer, ResultsFileName
 
 
 help_message = '''
@@ -23,31 +38,529 @@ The help message goes here.
 
 
 def GetImtype(imageFile):
-    RawFile = os.path.abspath(imageFile)
-    RawFileDirectory, RawFilename = os.path.split(RawFile)
-    RawBasename, RawExt = os.path.splitext(RawFilename)
-    DataNightDirectory, DataNightString = os.path.split(os.path.split(RawFileDirectory)[0])
-    infoFile = os.path.join(DataNightDirectory, DataNightString, "CR2info", RawBasename+'.info')
-
-    if not os.path.exists(infoFile):
-        time.sleep(2)
-
-    if os.path.exists(infoFile):
-        infoFO = open(infoFile, 'r')
-        info = infoFO.read()
-        lines = info.split("\n")
-        infoFO.close()
-        imtype = None
-        for line in lines:
-            IsMatch = re.match("IMTYPE:\s+(\w+)", line)
-            if IsMatch:
-                imtype = IsMatch.group(1)
-        if not imtype:
-            print("  Could not read image type from info file: {}".format(infoFile))
-        return imtype
-    else:
-        print("  Could not find image info file: {}".format(infoFile))
+    info = SkycamInfo.ReadInfo(imageFile)
+    if info is None:
         return None
+    if not info.imtype:
+        print("  Could not read image type from info file: {}".format(SkycamInfo.InfoFile(imageFile)))
+    return info.imtype
+
+
+##-------------------------------------------------------------------------
+## Watch Data Directory for New Files
+##-------------------------------------------------------------------------
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+
+
+class DirectoryWatcher(object):
+    '''Report files which appear in one or more directories.
+
+    On Linux inotify is used, so a file is reported as soon as it is closed
+    after writing or moved into a directory.  If the kernel event queue
+    overflows, the directories are listed again to find the files whose
+    events were lost.  Elsewhere, or if inotify is not available, the
+    directories are polled every poll seconds and a new file is reported
+    once its size is unchanged between two polls.  Files present when a
+    directory is added are not reported.
+    '''
+    def __init__(self, paths, poll=1.0):
+        self.poll = poll
+        self.paths = {}
+        self.known = set()
+        self.growing = {}
+        self.fd = None
+        try:
+            self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            self.fd = self.libc.inotify_init1(os.O_NONBLOCK)
+            if self.fd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        except (OSError, AttributeError):
+            print("  inotify not available, polling every {:.1f} s".format(poll))
+            self.fd = None
+        for path in paths:
+            self.AddPath(path)
+
+    def AddPath(self, path):
+        '''Start watching path for new files.'''
+        self.known.update(self.ListFiles(path))
+        wd = None
+        if self.fd is not None:
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO)
+            if wd < 0:
+                raise OSError(ctypes.get_errno(), "inotify_add_watch failed for {}".format(path))
+        self.paths[wd if wd is not None else path] = path
+
+    def ListFiles(self, path):
+        if hasattr(os, 'scandir'):
+            return [entry.path for entry in os.scandir(path) if entry.is_file()]
+        return [os.path.join(path, File) for File in os.listdir(path)]
+
+    def NewFiles(self, timeout=None):
+        '''Return a sorted list of paths of new files, waiting up to timeout seconds.'''
+        if self.fd is not None:
+            return self.ReadEvents(timeout)
+        else:
+            return self.PollDirectories(timeout)
+
+    def ReadEvents(self, timeout):
+        NewFiles = set()
+        readable = select.select([self.fd], [], [], timeout)[0]
+        while readable:
+            try:
+                buffer = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(buffer):
+                wd, mask, cookie, length = struct.unpack_from('iIII', buffer, offset)
+                offset += struct.calcsize('iIII')
+                name = os.fsdecode(buffer[offset:offset+length].rstrip(b'\0'))
+                offset += length
+                if wd == -1 and mask & IN_Q_OVERFLOW:
+                    print("  inotify event queue overflowed, rescanning watched directories")
+                    for path in self.paths.values():
+                        NewFiles.update(set(self.ListFiles(path)) - self.known)
+                elif name and wd in self.paths:
+                    File = os.path.join(self.paths[wd], name)
+                    if File not in self.known:
+                        NewFiles.add(File)
+        self.known.update(NewFiles)
+        return sorted(NewFiles)
+
+    def PollDirectories(self, timeout):
+        deadline = time.time() + (timeout or 0)
+        while True:
+            NewFiles = []
+            Files = set()
+            for path in self.paths.values():
+                Files.update(self.ListFiles(path))
+            for File in Files - self.known:
+                try:
+                    size = os.path.getsize(File)
+                except OSError:
+                    continue
+                if self.growing.get(File) == size:
+                    NewFiles.append(File)
+                    del self.growing[File]
+                else:
+                    self.growing[File] = size
+            self.known = (self.known & Files) | set(NewFiles)
+            if NewFiles or time.time() >= deadline:
+                return sorted(NewFiles)
+            time.sleep(self.poll)
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+##-------------------------------------------------------------------------
+## Pool of Workers Running MeasureImage
+##-------------------------------------------------------------------------
+def TerminateGroup(process, grace=10):
+    '''Stop the process group of process, started with os.setsid.
+
+    SIGTERM is sent first, which MeasureImage.py turns into an exception so
+    it removes its scratch directory, and SIGKILL if the group is still
+    running after grace seconds.
+    '''
+    os.killpg(process.pid, signal.SIGTERM)
+    try:
+        process.communicate(timeout=grace)
+    except subprocess.TimeoutExpired:
+        os.killpg(process.pid, signal.SIGKILL)
+        process.communicate()
+
+
+## Scheduling policies of MeasureImagePool
+Policies = ["fifo", "lifo", "latest"]
+
+
+class Job(object):
+    '''A frame waiting to be processed by MeasureImage.py.
+
+    detected is the time the frame was found, which may be before it was
+    queued if the queue waited for its info file.  camera is the name of
+    the camera which took the frame.
+    '''
+    def __init__(self, RawFile, detected=None, camera=None):
+        self.RawFile = RawFile
+        self.camera = camera
+        self.attempt = 0
+        self.queued = time.time()
+        self.detected = detected or self.queued
+        self.notBefore = self.queued
+        self.started = None
+        self.stages = {}
+        self.mode = "full"
+
+
+class MeasureImagePool(object):
+    '''Run MeasureImage.py on queued frames using a pool of worker threads.
+
+    Each call runs in its own process group, which is killed as a whole if
+    the call takes longer than timeout seconds.  A failed call is retried up
+    to retries times after waiting backoff, 2*backoff, ... seconds.  If more
+    than maxBacklog jobs are waiting, the oldest are dropped.
+
+    The policy decides which ready job runs next: "fifo" runs frames in the
+    order they were found, "lifo" always runs the newest frame and leaves
+    older frames for when the workers are otherwise idle, and "latest" does
+    the same but runs the oldest frame on every nth dispatch so the backlog
+    keeps moving.  Jobs from several cameras share the workers fairly: the
+    next job is taken from the camera with the fewest frames running, and
+    of those the one which waited longest since its last dispatch.  A full
+    backlog drops the oldest frame of the camera with the most queued.
+
+    If shedDepth or shedAge is given, frames are analyzed in reduced modes
+    while the backlog is large: once the number of queued frames reaches
+    shedDepth or the oldest has waited shedAge seconds the PSF plot and
+    jpeg are skipped, at twice the thresholds astrometry is skipped too, and
+    at three times only every shedNth frame is analyzed.  Full analysis
+    resumes when the backlog clears.
+
+    If warm is True, each worker thread keeps a long lived MeasureImage.py
+    --serve process and sends it frames over a Unix socket instead of
+    starting a new process for every frame.  If a FrameLedger is given, the
+    state of each frame is recorded in it, and if StageMetrics are given,
+    the time each successful frame spent in each stage is added to them.
+    '''
+    def __init__(self, command, workers=2, timeout=600, retries=2, backoff=30,
+                 maxBacklog=200, warm=False, ledger=None, policy="fifo", nth=4,
+                 metrics=None, shedDepth=None, shedAge=None, shedNth=3):
+        if policy not in Policies:
+            raise ValueError("Unknown scheduling policy: {}".format(policy))
+        self.command = command
+        self.warm = warm
+        self.ledger = ledger
+        self.metrics = metrics
+        self.shedDepth = shedDepth
+        self.shedAge = shedAge
+        self.shedNth = shedNth
+        self.shedCount = 0
+        self.mode = "full"
+        self.servers = [None] * workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.maxBacklog = maxBacklog
+        self.policy = policy
+        self.nth = nth
+        self.dispatched = {}
+        self.lastDispatch = {}
+        self.jobs = []
+        self.active = 0
+        self.activeByCamera = {}
+        self.running = True
+        self.condition = threading.Condition()
+        self.threads = [threading.Thread(target=self.Worker, args=(i,)) for i in range(workers)]
+        for thread in self.threads:
+            thread.daemon = True
+            thread.start()
+
+    def Submit(self, RawFile, detected=None, camera=None):
+        with self.condition:
+            self.jobs.append(Job(RawFile, detected=detected, camera=camera))
+            self.SetState(RawFile, "pending")
+            while len(self.jobs) > self.maxBacklog:
+                cameras = [job.camera for job in self.jobs]
+                busiest = max(set(cameras), key=cameras.count)
+                dropped = [job for job in self.jobs if job.camera == busiest][0]
+                self.jobs.remove(dropped)
+                print("  Backlog is full, dropping {}".format(dropped.RawFile))
+                self.SetState(dropped.RawFile, "skipped", "Dropped from backlog")
+            self.condition.notify()
+
+    def SetState(self, RawFile, state, message=None):
+        if self.ledger:
+            try:
+                self.ledger.SetState(RawFile, state, message)
+            except Exception:
+                print("  Could not record {} as {} in the ledger: {}".format(\
+                      os.path.basename(RawFile), state, sys.exc_info()[1]))
+
+    def NextJob(self):
+        '''Remove and return the next job which may run now.
+
+        If no job is ready, return None and the number of seconds until one
+        will be, or None if the queue is empty.
+        '''
+        now = time.time()
+        ready = [job for job in self.jobs if job.notBefore <= now]
+        if not ready:
+            if self.jobs:
+                return None, min([job.notBefore for job in self.jobs]) - now
+            return None, None
+        camera = min(set([job.camera for job in ready]),
+                     key=lambda camera: (self.activeByCamera.get(camera, 0),
+                                         self.lastDispatch.get(camera, 0)))
+        ready = [job for job in ready if job.camera == camera]
+        self.lastDispatch[camera] = now
+        self.dispatched[camera] = self.dispatched.get(camera, 0) + 1
+        if self.policy == "fifo":
+            job = min(ready, key=lambda job: job.queued)
+        elif self.policy == "latest" and self.nth > 0 and self.dispatched[camera] % self.nth == 0:
+            job = min(ready, key=lambda job: job.queued)
+        else:
+            job = max(ready, key=lambda job: job.queued)
+        self.jobs.remove(job)
+        return job, None
+
+    def QueueAge(self):
+        '''Return the number of queued jobs and the age of the oldest in seconds.'''
+        if not self.jobs:
+            return 0, 0.
+        return len(self.jobs), time.time() - min([job.queued for job in self.jobs])
+
+    def ShedLoad(self, depth, age):
+        '''Return the analysis mode for a backlog of depth frames, the oldest
+        of which has waited age seconds, and whether to skip the frame.
+        '''
+        load = 0.
+        if self.shedDepth:
+            load = max(load, depth / self.shedDepth)
+        if self.shedAge:
+            load = max(load, age / self.shedAge)
+        mode = "full" if load < 1 else "noplots" if load < 2 else "minimal"
+        if mode != self.mode:
+            print("  Backlog of {} frames, oldest {:.0f} s: switching to {} analysis".format(depth, age, mode))
+            self.mode = mode
+        skip = False
+        if load >= 3 and self.shedNth > 1:
+            self.shedCount += 1
+            skip = self.shedCount % self.shedNth != 0
+        return mode, skip
+
+    def Worker(self, index):
+        while True:
+            with self.condition:
+                job = None
+                while job is None:
+                    if not self.running:
+                        return
+                    job, wait = self.NextJob()
+                    if job is None:
+                        self.condition.wait(wait)
+                depth, age = self.QueueAge()
+                job.mode, skip = self.ShedLoad(depth, age)
+                if skip:
+                    print("  Skipping {} to reduce the backlog".format(os.path.basename(job.RawFile)))
+                    self.SetState(job.RawFile, "skipped", "Skipped to reduce the backlog")
+                    self.condition.notify_all()
+                    continue
+                self.active += 1
+                self.activeByCamera[job.camera] = self.activeByCamera.get(job.camera, 0) + 1
+            print("  Dispatching {} after {:.0f} s in queue ({} queued, oldest {:.0f} s)".format(\
+                  os.path.basename(job.RawFile), time.time() - job.queued, depth, age))
+            self.SetState(job.RawFile, "running")
+            job.started = time.time()
+            ## Any error is a failed attempt, so the job is still retried
+            ## and the worker lives on
+            try:
+                success = self.RunJob(job, index)
+            except Exception:
+                print("  Call to MeasureImage.py raised {}: {}".format(repr(sys.exc_info()[1]), job.RawFile))
+                success = False
+            if success and self.metrics:
+                try:
+                    self.Observe(job)
+                except Exception:
+                    print("  Could not record stage times of {}: {}".format(job.RawFile, sys.exc_info()[1]))
+            with self.condition:
+                self.active -= 1
+                self.activeByCamera[job.camera] -= 1
+                if success:
+                    self.SetState(job.RawFile, "done", None if job.mode == "full" else "Mode: "+job.mode)
+                elif job.attempt < self.retries:
+                    job.attempt += 1
+                    job.notBefore = time.time() + self.backoff * 2**(job.attempt-1)
+                    print("  Retrying {} in {:.0f} s".format(job.RawFile, job.notBefore - time.time()))
+                    self.jobs.append(job)
+                    self.SetState(job.RawFile, "pending")
+                else:
+                    self.SetState(job.RawFile, "failed", "Failed after {} attempts".format(job.attempt+1))
+                self.condition.notify_all()
+
+    def Observe(self, job):
+        '''Add the stage times of a finished job to the metrics.
+
+        The times reported by MeasureImage.py are preceded by the wait for
+        the info file and the wait in the queue.
+        '''
+        stages = OrderedDict([("info_wait", job.queued - job.detected),
+                              ("queue", job.started - job.queued)])
+        stages.update(job.stages)
+        stages["total"] = time.time() - job.detected
+        self.metrics.Observe(job.RawFile, stages)
+
+    def RunJob(self, job, index):
+        if self.warm:
+            return self.RunWarmJob(job, index)
+        ProcessCall = list(self.command)
+        if job.camera:
+            ProcessCall += ["--telescope", job.camera]
+        if job.mode != "full":
+            ProcessCall += ["--mode", job.mode]
+        ProcessCall.append(job.RawFile)
+        TimeString = time.strftime("%Y-%m-%d %H:%M:%S -", time.gmtime())
+        print("  %s Calling MeasureImage.py with %s" % (TimeString, ProcessCall[2:]))
+        startTime = time.time()
+        process = subprocess.Popen(ProcessCall, stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                                   universal_newlines=True, preexec_fn=os.setsid)
+        try:
+            MIoutput = process.communicate(timeout=self.timeout)[0]
+        except subprocess.TimeoutExpired:
+            TerminateGroup(process)
+            print("  Call to MeasureImage.py timed out after {} s: {}".format(self.timeout, job.RawFile))
+            return False
+        if process.returncode != 0:
+            print("  Call to MeasureImage.py Failed")
+            print("  Command: {}".format(ProcessCall))
+            print("  Returncode: {}".format(process.returncode))
+            print("  Output: {}".format(MIoutput))
+            return False
+        for line in MIoutput.splitlines():
+            if line.startswith("Stage times: "):
+                job.stages = json.loads(line[len("Stage times: "):], object_pairs_hook=OrderedDict)
+        print("  Call to MeasureImage.py Succeeded in {:.1f} s: {}".format(time.time() - startTime, job.RawFile))
+        return True
+
+    def StartServer(self, index):
+        SocketPath = os.path.join(tempfile.gettempdir(),
+                                  "MeasureImage_{}_{}.sock".format(os.getpid(), index))
+        process = subprocess.Popen(self.command + ["--serve", SocketPath], preexec_fn=os.setsid)
+        self.servers[index] = (process, SocketPath)
+
+    def StopServer(self, index):
+        if self.servers[index]:
+            process, SocketPath = self.servers[index]
+            if process.poll() is None:
+                TerminateGroup(process)
+            if os.path.exists(SocketPath): os.remove(SocketPath)
+            self.servers[index] = None
+
+    def RunWarmJob(self, job, index):
+        if not self.servers[index] or self.servers[index][0].poll() is not None:
+            self.StopServer(index)
+            self.StartServer(index)
+        process, SocketPath = self.servers[index]
+        TimeString = time.strftime("%Y-%m-%d %H:%M:%S -", time.gmtime())
+        print("  %s Sending %s to MeasureImage.py worker %d" % (TimeString, job.RawFile, index))
+        startTime = time.time()
+        deadline = startTime + self.timeout
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            ## The worker may still be starting up
+            while True:
+                try:
+                    connection.connect(SocketPath)
+                    break
+                except socket.error:
+                    if time.time() > deadline or process.poll() is not None:
+                        raise
+                    time.sleep(0.2)
+            connection.settimeout(max(deadline - time.time(), 0.1))
+            request = {"filename": job.RawFile}
+            if job.camera:
+                request["telescope"] = job.camera
+            if job.mode != "full":
+                request["mode"] = job.mode
+            connection.sendall((json.dumps(request)+"\n").encode('utf-8'))
+            reply = json.loads(connection.makefile('r').readline(), object_pairs_hook=OrderedDict)
+        except (socket.error, ValueError):
+            print("  Call to MeasureImage.py worker {} failed or timed out: {}".format(index, job.RawFile))
+            self.StopServer(index)
+            return False
+        finally:
+            connection.close()
+        if reply["status"] != "ok":
+            print("  Call to MeasureImage.py worker {} Failed: {}".format(index, reply["status"]))
+            return False
+        job.stages = reply.get("stages", {})
+        print("  Call to MeasureImage.py Succeeded in {:.1f} s ({:.1f} s processing): {}".format(\
+              time.time() - startTime, reply["seconds"], job.RawFile))
+        return True
+
+    def Drain(self):
+        '''Wait for all queued jobs to finish, then stop the workers.'''
+        with self.condition:
+            while self.jobs or self.active:
+                self.condition.wait()
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+        for index in range(len(self.servers)):
+            self.StopServer(index)
+
+
+##-------------------------------------------------------------------------
+## Cameras
+##-------------------------------------------------------------------------
+DefaultCamera = "Panoptes=/skycamdata"
+DefaultLogPath = os.path.join("/home", "panoptesmlo", "IQMon", "Logs")
+
+
+def ParseCamera(spec):
+    '''Split a NAME=ROOT camera specification into its name and root.'''
+    if "=" not in spec:
+        raise ValueError("Camera must be given as NAME=ROOT: {}".format(spec))
+    name, root = spec.split("=", 1)
+    return name, root
+
+
+class Camera(object):
+    '''A camera whose frames for each night are written to root/<date>/CR2
+    and their info files to root/<date>/CR2info.
+
+    name is also the telescope profile MeasureImage.py uses for its frames.
+    '''
+    def __init__(self, name, root):
+        self.name = name
+        self.root = os.path.abspath(root)
+        self.DateString = None
+
+    def NightPath(self, DateString):
+        return os.path.join(self.root, DateString)
+
+    def StartNight(self, DateString, watcher):
+        '''Create and watch the directories for a night.
+
+        Return the frames already in the data directory.
+        '''
+        PathForDate = self.NightPath(DateString)
+        DataPath = os.path.join(PathForDate, "CR2")
+        InfoPath = os.path.join(PathForDate, "CR2info")
+        for path in [PathForDate, DataPath, InfoPath]:
+            if not os.path.exists(path): os.mkdir(path)
+        watcher.AddPath(DataPath)
+        watcher.AddPath(InfoPath)
+        self.DateString = DateString
+        return [os.path.join(DataPath, File) for File in sorted(os.listdir(DataPath))
+                if re.match("IMG0_\d{4}\.CR2", File)]
+
+
+def FindCamera(cameras, File):
+    '''Return the camera whose root contains File, or None.'''
+    for camera in cameras:
+        if File.startswith(camera.root + os.sep):
+            return camera
+    return None
+
+
+def RenderAll(renderers):
+    '''Render the results of every camera and night which have new rows.'''
+    for (name, DateString), renderer in sorted(renderers.items()):
+        try:
+            nRows = renderer.Render()
+        except:
+            print("Could not render results of {} for {}: {}".format(name, DateString, sys.exc_info()[1]))
+            continue
+        if nRows:
+            print("Rendered {} new results of {} for {}".format(nRows, name, DateString))
 
 
 def main(argv=None):  
@@ -56,37 +569,118 @@ def main(argv=None):
     ##-------------------------------------------------------------------------
     ## create a parser object for understanding command-line arguments
     parser = ArgumentParser(description="Describe the script")
+    ## add flags
+    parser.add_argument("-w", "--workers",
+        type=int, dest="workers", default=2,
+        help="Number of frames analyzed concurrently. (default = 2)")
+    parser.add_argument("--timeout",
+        type=float, dest="timeout", default=600,
+        help="Seconds before a MeasureImage.py call is killed. (default = 600)")
+    parser.add_argument("--retries",
+        type=int, dest="retries", default=2,
+        help="Number of times a failed frame is retried. (default = 2)")
+    parser.add_argument("--backoff",
+        type=float, dest="backoff", default=30,
+        help="Seconds before the first retry, doubled for each further retry. (default = 30)")
+    parser.add_argument("--max-backlog",
+        type=int, dest="maxbacklog", default=200,
+        help="Maximum number of queued frames, the oldest are dropped beyond this. (default = 200)")
+    parser.add_argument("--info-deadline",
+        type=float, dest="infodeadline", default=60,
+        help="Seconds to wait for the info file of a new frame. (default = 60)")
+    parser.add_argument("--warm",
+        action="store_true", dest="warm", default=False,
+        help="Keep long lived MeasureImage.py workers instead of starting one per frame. (default = False)")
+    parser.add_argument("--ledger",
+        type=str, dest="ledger", default=DefaultLedgerFile,
+        help="SQLite file recording which frames have been processed. (default = {})".format(DefaultLedgerFile))
+    parser.add_argument("--policy",
+        type=str, dest="policy", default="latest", choices=Policies,
+        help="Order in which queued frames are analyzed: fifo, lifo (newest first) or latest (newest first, oldest on every nth). (default = latest)")
+    parser.add_argument("--nth",
+        type=int, dest="nth", default=4,
+        help="With --policy latest, analyze the oldest queued frame on every nth dispatch. (default = 4)")
+    parser.add_argument("--metrics",
+        type=str, dest="metrics", default=None,
+        help="Write rolling stage latency histograms to this Prometheus textfile. (default = None)")
+    parser.add_argument("--metrics-json",
+        type=str, dest="metricsjson", default=None,
+        help="Append the stage latencies of each frame to this JSON lines file. (default = None)")
+    parser.add_argument("--metrics-window",
+        type=int, dest="metricswindow", default=200,
+        help="Number of recent frames included in the latency histograms. (default = 200)")
+    parser.add_argument("--shed-depth",
+        type=int, dest="sheddepth", default=None,
+        help="Reduce the analysis once this many frames are queued. (default = None)")
+    parser.add_argument("--shed-age",
+        type=float, dest="shedage", default=None,
+        help="Reduce the analysis once the oldest queued frame has waited this many seconds. (default = None)")
+    parser.add_argument("--shed-nth",
+        type=int, dest="shednth", default=3,
+        help="Analyze only every nth frame at three times the --shed-depth or --shed-age threshold. (default = 3)")
+    parser.add_argument("--scratch",
+        type=str, dest="scratch", default=None,
+        help="Directory for MeasureImage.py temporary files, e.g. a tmpfs such as /dev/shm. (default = None)")
+    parser.add_argument("--crop",
+        action="store_true", dest="crop", default=False,
+        help="Have MeasureImage.py crop each image to the telescope ROI before analysis. (default = False)")
+    parser.add_argument("--results",
+        type=str, dest="results", default=None,
+        help="SQLite file MeasureImage.py adds the results of each frame to. (default = {} in the log directory)".format(ResultsFileName))
+    parser.add_argument("--logs",
+        type=str, dest="logs", default=DefaultLogPath,
+        help="IQMon log directory, the HTML tables and summary files are rendered to it. (default = {})".format(DefaultLogPath))
+    parser.add_argument("--render-interval",
+        type=float, dest="renderinterval", default=30,
+        help="Seconds between updates of the HTML tables and summary files from the results. (default = 30)")
+    parser.add_argument("--camera",
+        type=str, dest="cameras", action="append",
+        help="Camera to watch as NAME=ROOT, frames are in ROOT/<date>/CR2.  May be given more than once. (default = {})".format(DefaultCamera))
+    parser.add_argument("--stop-hour",
+        type=float, dest="stophour", default=None,
+        help="Stop after this UT hour instead of running on to the next night. (default = None)")
     ## add arguments
     args = parser.parse_args()
-    telescope = "Panoptes"
-    
-    ##-------------------------------------------------------------------------
-    ## Set date to tonight
-    ##-------------------------------------------------------------------------
-    now = time.gmtime()
-    DateString = time.strftime("%Y-%m-%d", now)
-
-    ##-------------------------------------------------------------------------
-    ## Set data path
-    ##-------------------------------------------------------------------------
-    PathForDate = os.path.join("/skycamdata", DateString)
-    DataPath = os.path.join(PathForDate, "CR2")
-
+    cameras = [Camera(*ParseCamera(spec)) for spec in (args.cameras or [DefaultCamera])]
 
     ##-------------------------------------------------------------------------
-    ## Look for Pre-existing Files
+    ## Create Watcher, Ledger and Pool
     ##-------------------------------------------------------------------------
-    if not os.path.exists(PathForDate): os.mkdir(PathForDate)
-    if not os.path.exists(DataPath): os.mkdir(DataPath)
-    PreviousFiles = os.listdir(DataPath)
-    PreviousFilesTime = time.gmtime()
+    watcher = DirectoryWatcher([])
+    ## Frames waiting for their info file, with their camera and the time to
+    ## give up waiting
+    Pending = {}
+    ledger = FrameLedger(args.ledger)
+    ## HTML tables and summary files rendered from the results store, for
+    ## each camera and night
+    if not args.results:
+        args.results = os.path.join(args.logs, ResultsFileName)
+    results = ResultsStore(args.results)
+    renderers = {}
+    lastRender = 0
+    PythonString = sys.executable
+    homePath = os.path.expandvars("$HOME")
+    MeasureImageString = os.path.join(homePath, "bin", "Panoptes", "MeasureImage.py")
+    metrics = None
+    if args.metrics or args.metricsjson:
+        metrics = StageMetrics(prometheusFile=args.metrics, jsonFile=args.metricsjson,
+                               window=args.metricswindow)
+    MeasureImageCall = [PythonString, MeasureImageString, "--results", args.results]
+    if args.scratch:
+        MeasureImageCall += ["--scratch", args.scratch]
+    if args.crop:
+        MeasureImageCall.append("--crop")
+    pool = MeasureImagePool(MeasureImageCall, workers=args.workers,
+                            timeout=args.timeout, retries=args.retries,
+                            backoff=args.backoff, maxBacklog=args.maxbacklog,
+                            warm=args.warm, ledger=ledger,
+                            policy=args.policy, nth=args.nth, metrics=metrics,
+                            shedDepth=args.sheddepth, shedAge=args.shedage,
+                            shedNth=args.shednth)
 
     ##-------------------------------------------------------------------------
     ## Operation Loop
     ##-------------------------------------------------------------------------
-    PythonString = os.path.join("/usr", "bin", "python")
-    homePath = os.path.expandvars("$HOME")
-    MeasureImageString = os.path.join(homePath, "bin", "Panoptes", "MeasureImage.py")
     Operate = True
     while Operate:
         ## Set date to tonight
@@ -94,71 +688,85 @@ def main(argv=None):
         nowDecimalHours = now.tm_hour + now.tm_min/60. + now.tm_sec/3600.
         DateString = time.strftime("%Y-%m-%d", now)
         TimeString = time.strftime("%Y-%m-%d %H:%M:%S -", now)
-        
-        Files = os.listdir(DataPath)
-        FilesTime = now
-        
-        time.sleep(1)
-                
-        if len(Files) > len(PreviousFiles):
-            for File in Files:
-                FileFound = False
-                for PreviousFile in PreviousFiles:
-                    if File == PreviousFile:
-                        FileFound = True
-                if not FileFound:
-                    if re.match("IMG0_\d{4}\.CR2", File):
-                        print("New image File Found:  %s" % File)
-                        imtype = GetImtype(os.path.join(DataPath, File))
-                        if not imtype:
-                            print("  Waiting 10 seconds for info file to be written.")
-                            time.sleep(10)  ## Wait for info file to be written
-                            imtype = GetImtype(os.path.join(DataPath, File))
-                        if not imtype:
-                            print("  Waiting 20 seconds for info file to be written.")
-                            time.sleep(20)  ## Wait for info file to be written
-                            imtype = GetImtype(os.path.join(DataPath, File))
-                        if imtype and imtype == "OBJECT":
-                            ProcessCall = [PythonString, MeasureImageString, os.path.join(DataPath, File)]
-                            print("  %s Calling MeasureImage.py with %s" % (TimeString, ProcessCall[2:]))
-                            try:
-                                MIoutput = subprocess.check_output(ProcessCall, stderr=subprocess.STDOUT, universal_newlines=True)
-                                print("  Call to MeasureImage.py Succeeded")
-                            except subprocess.CalledProcessError as e:
-                                print("  Call to MeasureImage.py Failed")
-                                print("  Command: {}".format(e.command))
-                                print("  Returncode: {}".format(e.returncode))
-                                print("  Output: {}".format(e.output))
-                            except:
-                                print("  Call to MeasureImage.py Failed: {0} {1} {2}".format(sys.exc_info()[0], sys.exc_info()[1], sys.exc_info()[2]))
-                        else:
-                            print("  File ImType is {}.  MeasureImage not called.".format(imtype))
-        PreviousFiles = Files
-        PreviousFilesTime = now
-        
+
+        ## Start watching the directories of a new night, and queue frames
+        ## taken before a restart or before the night was switched which have
+        ## not been processed yet
+        for camera in cameras:
+            if camera.DateString != DateString:
+                print("Watching {} for camera {}".format(camera.NightPath(DateString), camera.name))
+                Earlier = [RawFile for RawFile in camera.StartNight(DateString, watcher)
+                           if ledger.NeedsProcessing(RawFile)]
+                renderers[(camera.name, DateString)] = NightRenderer(results, camera.name, DateString, args.logs)
+                for RawFile in Earlier:
+                    Pending[RawFile] = (camera, time.time() + args.infodeadline)
+                if Earlier:
+                    print("Found {} earlier frames from {} which have not been processed".format(\
+                          len(Earlier), camera.name))
+
+        ## Wait for new files, returns as soon as a file has been written.  New
+        ## info files also end the wait, so pending frames are checked at once.
+        NewFiles = watcher.NewFiles(timeout=1 if Pending else 5)
+        for NewFile in NewFiles:
+            File = os.path.basename(NewFile)
+            camera = FindCamera(cameras, NewFile)
+            if camera and re.match("IMG0_\d{4}\.CR2", File):
+                print("New image File Found for {}:  {}".format(camera.name, File))
+                Pending[NewFile] = (camera, time.time() + args.infodeadline)
+
+        ## Check frames waiting for their info file
+        for RawFile in sorted(Pending.keys()):
+            camera, deadline = Pending[RawFile]
+            imtype = GetImtype(RawFile)
+            if not imtype and time.time() < deadline:
+                continue
+            del Pending[RawFile]
+            if imtype and imtype == "OBJECT":
+                print("  %s Queueing %s for MeasureImage.py" % (TimeString, os.path.basename(RawFile)))
+                pool.Submit(RawFile, detected=deadline - args.infodeadline, camera=camera.name)
+            elif not imtype:
+                print("  No image type for {} after {:.0f} s.  MeasureImage not called.".format(\
+                      os.path.basename(RawFile), args.infodeadline))
+            else:
+                print("  File ImType is {}.  MeasureImage not called.".format(imtype))
+
         ##-------------------------------------------------------------------------
-        ## Create Link to Tonight HTML File
+        ## Render HTML Tables and Summary Files of Frames Analyzed Since Last Time
         ##-------------------------------------------------------------------------
-        linkTarget = os.path.join("/home" , "panoptesmlo", "IQMon", "Logs", DateString+"_Panoptes.html")
-        linkFile = os.path.join("/home" , "panoptesmlo", "IQMon", "Logs", "tonight.html")
-        ## If the tonight.html file already exists, remove it.
-        if os.path.exists(linkFile):
-            if (os.readlink(linkFile) != linkTarget) and (os.path.exists(linkTarget)):
-                print('Removing old tonight.html file')
-                os.remove(linkFile)
-        ## Use os.symlink to link tonight.html to the correct file
-        if not os.path.exists(linkFile):
-            try:
-                print('Making tonight.html symlink')
-                os.symlink(linkTarget, linkFile)
-            except:
-                print("Could not create link to tonight's data.")
-                for element in sys.exc_info():
-                    print(element)
-
-        time.sleep(5)
-        if nowDecimalHours > 17.0:
+        if time.time() - lastRender >= args.renderinterval:
+            RenderAll(renderers)
+            lastRender = time.time()
+
+        ##-------------------------------------------------------------------------
+        ## Create Links to Tonight HTML Files
+        ##-------------------------------------------------------------------------
+        for camera in cameras:
+            ## The first camera keeps the original tonight.html name
+            linkName = "tonight.html" if camera is cameras[0] else "tonight_{}.html".format(camera.name)
+            linkTarget = os.path.join(args.logs, DateString+"_"+camera.name+".html")
+            linkFile = os.path.join(args.logs, linkName)
+            ## If the tonight.html file already exists, remove it.
+            if os.path.exists(linkFile):
+                if (os.readlink(linkFile) != linkTarget) and (os.path.exists(linkTarget)):
+                    print('Removing old {} file'.format(linkName))
+                    os.remove(linkFile)
+            ## Use os.symlink to link tonight.html to the correct file
+            if not os.path.exists(linkFile):
+                try:
+                    print('Making {} symlink'.format(linkName))
+                    os.symlink(linkTarget, linkFile)
+                except:
+                    print("Could not create link to tonight's data.")
+                    for element in sys.exc_info():
+                        print(element)
+
+        if args.stophour is not None and nowDecimalHours > args.stophour:
             Operate = False
+    watcher.close()
+    pool.Drain()
+    RenderAll(renderers)
+    results.close()
+    ledger.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+ResultsStore.py
+
+Append-only SQLite store of the results of each analyzed frame.  MeasureImage.py
+adds one row per frame, and the nightly HTML table and summary text file are
+rendered from the store by Monitor.py, MeasureNight.py or this script.
+"""
+
+from __future__ import division, print_function
+
+import sys
+import os
+import time
+import sqlite3
+import threading
+from argparse import ArgumentParser
+
+
+## Name of the store in the IQMon log directory, which also holds the
+## rendered files
+ResultsFileName = "Results.sqlite"
+
+## Results recorded for each frame, in the order of the HTML and summary columns
+Fields = ["Date and Time", "Filename", "Target", "ExpTime", "Alt", "Az", "Airmass",
+          "MoonSep", "MoonIllum", "FWHM", "ellipticity", "Background", "PErr",
+          "PosAng", "nStars", "ProcessTime"]
+
+## Columns of each row besides the fields
+Columns = ["id", "recorded", "telescope", "night", "mode", "links"]
+
+
+def Quote(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+class ResultsStore(object):
+    '''SQLite table with one row for every time a frame was analyzed.
+
+    Rows are only ever added.  A frame which is analyzed again gets a new
+    row, and the renderers show the latest row of each frame.  Clobbering a
+    night records the last row id at that time, and the rows up to it are
+    no longer returned for that telescope and night.  The database
+    uses write-ahead logging, so several MeasureImage.py processes can add
+    rows while the tables are rendered.
+    '''
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        self.connection.row_factory = sqlite3.Row
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS results (
+                                       id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                       recorded REAL,
+                                       telescope TEXT,
+                                       night TEXT,
+                                       mode TEXT,
+                                       links TEXT, {})'''.format(\
+                                    ", ".join([Quote(field) for field in Fields])))
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS clobbers (
+                                       recorded REAL,
+                                       telescope TEXT,
+                                       night TEXT,
+                                       cutoff INTEGER)''')
+
+    def Add(self, telescope, night, values, mode="full", links=None):
+        '''Add a row with the values of Fields given in the dict values.
+
+        links is a list of files, such as plots, which the HTML table links to
+        once they exist.
+        '''
+        names = ["recorded", "telescope", "night", "mode", "links"] + Fields
+        row = [time.time(), telescope, night, mode, "\n".join(links or [])]
+        row += [values.get(field) for field in Fields]
+        with self.lock, self.connection:
+            self.connection.execute("INSERT INTO results ({}) VALUES ({})".format(\
+                                    ", ".join([Quote(name) for name in names]),
+                                    ", ".join(["?"]*len(names))), row)
+
+    def Clobber(self, telescope, night):
+        '''Hide the rows added so far for a telescope and night.'''
+        with self.lock, self.connection:
+            self.connection.execute('''INSERT INTO clobbers VALUES (?, ?, ?,
+                                       (SELECT coalesce(max(id), 0) FROM results))''',
+                                    (time.time(), telescope, night))
+
+    def Cutoff(self, telescope, night):
+        '''Return the id of the last row hidden by clobbering the night, or 0.'''
+        with self.lock:
+            row = self.connection.execute("SELECT max(cutoff) FROM clobbers WHERE telescope = ? AND night = ?",
+                                          (telescope, night)).fetchone()
+        return row[0] or 0
+
+    def Rows(self, telescope, night, after=0, latest=False):
+        '''Return the rows of a night with an id above after, oldest first.
+
+        Rows hidden by clobbering the night are left out.  If latest is True
+        only the last row of each frame is returned.
+        '''
+        after = max(after, self.Cutoff(telescope, night))
+        query = "SELECT * FROM results WHERE telescope = ? AND night = ? AND id > ?"
+        if latest:
+            query += ''' AND id IN (SELECT max(id) FROM results WHERE telescope = ? AND night = ?
+                                    GROUP BY {})'''.format(Quote("Filename"))
+        query += " ORDER BY id"
+        arguments = (telescope, night, after) + ((telescope, night) if latest else ())
+        with self.lock:
+            return [dict(row) for row in self.connection.execute(query, arguments)]
+
+    def LastId(self, telescope, night):
+        with self.lock:
+            row = self.connection.execute("SELECT max(id) FROM results WHERE telescope = ? AND night = ?",
+                                          (telescope, night)).fetchone()
+        return row[0] or 0
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+##-------------------------------------------------------------------------
+## Render the HTML Table and Summary File of a Night
+##-------------------------------------------------------------------------
+def FormatValue(value):
+    if value is None:
+        return "--"
+    if isinstance(value, float):
+        return "{:.2f}".format(value)
+    return str(value)
+
+
+class NightRenderer(object):
+    '''Render the results of one telescope and night from a ResultsStore.
+
+    The files are named like those IQMon writes, <night>_<telescope>.html and
+    <night>_<telescope>_Summary.txt in LogPath.  Render does nothing unless
+    rows were added since the last call.  The summary file is rewritten on
+    the first call and after the night was clobbered, and otherwise only has
+    the new rows appended, the HTML table is rewritten with the latest row of
+    each frame.
+    '''
+    def __init__(self, store, telescope, night, LogPath):
+        self.store = store
+        self.telescope = telescope
+        self.night = night
+        self.htmlFile = os.path.join(LogPath, night+"_"+telescope+".html")
+        self.summaryFile = os.path.join(LogPath, night+"_"+telescope+"_Summary.txt")
+        self.lastId = None
+        self.cutoff = 0
+
+    def Render(self):
+        '''Update the files if there are new rows, return the number of new rows.'''
+        cutoff = self.store.Cutoff(self.telescope, self.night)
+        if cutoff != self.cutoff:
+            self.lastId = None
+            self.cutoff = cutoff
+        lastId = self.store.LastId(self.telescope, self.night)
+        if self.lastId is not None and lastId == self.lastId:
+            return 0
+        newRows = self.store.Rows(self.telescope, self.night, after=self.lastId or 0)
+        self.RenderSummary(newRows, append=self.lastId is not None)
+        self.RenderHTML(self.store.Rows(self.telescope, self.night, latest=True))
+        ## Rows added after LastId was read are already in the summary
+        self.lastId = max([row["id"] for row in newRows] + [lastId])
+        return len(newRows)
+
+    def RenderSummary(self, rows, append=False):
+        names = ["mode"] + Fields
+        lines = []
+        if not append:
+            lines.append(" ".join([name.replace(" ", "_") for name in names]))
+        for row in rows:
+            lines.append(" ".join([FormatValue(row[name]).replace(" ", "_") for name in names]))
+        if append:
+            with open(self.summaryFile, 'a') as summaryFO:
+                summaryFO.write("".join([line+"\n" for line in lines]))
+        else:
+            WriteAtomically(self.summaryFile, "".join([line+"\n" for line in lines]))
+
+    def RenderHTML(self, rows):
+        htmlDirectory = os.path.dirname(os.path.abspath(self.htmlFile))
+        lines = ["<html>",
+                 "<head><title>IQMon Results for {} on {}</title></head>".format(self.telescope, self.night),
+                 "<body>",
+                 "<table border=1 cellpadding=4>",
+                 "  <tr>"+"".join(["<th>{}</th>".format(field) for field in Fields+["Mode"]])+"</tr>"]
+        for row in rows:
+            cells = []
+            for field in Fields:
+                cell = FormatValue(row[field])
+                if field == "Filename":
+                    for link in [link for link in (row["links"] or "").split("\n") if link]:
+                        if os.path.exists(link):
+                            cell += " (<a href='{}'>{}</a>)".format(os.path.relpath(link, htmlDirectory),
+                                                                    os.path.splitext(link)[0].split("_")[-1])
+                cells.append("<td>{}</td>".format(cell))
+            cells.append("<td>{}</td>".format(row["mode"]))
+            lines.append("  <tr>"+"".join(cells)+"</tr>")
+        lines += ["</table>", "</body>", "</html>"]
+        WriteAtomically(self.htmlFile, "\n".join(lines)+"\n")
+
+
+def WriteAtomically(filename, text):
+    '''Write text under a temporary name and rename it to filename.'''
+    TempFile = filename + ".tmp"
+    with open(TempFile, 'w') as fileFO:
+        fileFO.write(text)
+    os.rename(TempFile, filename)
+
+
+##-------------------------------------------------------------------------
+## Main Program
+##-------------------------------------------------------------------------
+def main():
+    parser = ArgumentParser(description="Render the HTML table and summary file of a night from the results store.")
+    parser.add_argument("-d", "--date",
+        type=str, dest="date", default=time.strftime("%Y-%m-%d", time.gmtime()),
+        help="UT date of the night to render. (default = today)")
+    parser.add_argument("-t", "--telescope",
+        type=str, dest="telescope", default="Panoptes",
+        help="Name of the telescope. (default = Panoptes)")
+    parser.add_argument("--logs",
+        type=str, dest="logs", required=True,
+        help="IQMon log directory, the files are written to it.")
+    parser.add_argument("--results",
+        type=str, dest="results", default=None,
+        help="SQLite file holding the results. (default = {} in the log directory)".format(ResultsFileName))
+    args = parser.parse_args()
+    if not args.results:
+        args.results = os.path.join(args.logs, ResultsFileName)
+
+    store = ResultsStore(args.results)
+    nRows = NightRenderer(store, args.telescope, args.date, LogPath=args.logs).Render()
+    print("Rendered {} results for {} on {}".format(nRows, args.telescope, args.date))
+    store.close()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
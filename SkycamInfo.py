@@ -0,0 +1,217 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+SkycamInfo.py
+
+Reads the .info files which skycam.c writes next to each CR2 image, shared by
+MeasureImage.py, Monitor.py and MeasureNight.py.  Each file is parsed once
+into an InfoRecord, and the records of a night are kept in an index file in
+its CR2info directory, so selecting the frames of a night does not open
+every info file.  SkycamHeader turns the info file of an image into the
+cards of its FITS header.
+"""
+
+from __future__ import division, print_function
+
+import os
+import re
+import math
+import json
+from collections import namedtuple
+
+import astropy.io.fits as fits
+
+
+## Fields of an info file, all None if not present in the file.  exptime is
+## in seconds, ra and dec in decimal degrees, utstart in decimal hours.
+InfoRecord = namedtuple("InfoRecord", ["imtype", "target", "exptime", "ra", "dec", "utstart"])
+
+## Keyword of each line, with the pattern of its value and the field it sets
+InfoPatterns = {
+                "IMTYPE": (re.compile("\s+(\w+)"), "imtype", str),
+                "TARGETDESCRIPTION": (re.compile("\s*(\w+)"), "target", str),
+                "SHUTTER": (re.compile("\s*(\d+\.?\d*)\ssec"), "exptime", float),
+                "RA": (re.compile("\s*(\d+\.?\d*)\sdeg"), "ra", float),
+                "DEC": (re.compile("\s*(\-?\d+\.?\d*)\sdeg"), "dec", float),
+                "UT_START": (re.compile("\s*(\d+\.?\d*)\shr"), "utstart", float),
+                }
+
+IndexFileName = ".info_index.json"
+
+## Records of parsed info files keyed by path, with the size and modification
+## time of the file when it was parsed
+_cache = {}
+
+
+def InfoFile(RawFile):
+    '''Return the path of the info file of a raw image.
+
+    The images of a night are in <night>/CR2 and the info files in
+    <night>/CR2info.
+    '''
+    RawFileDirectory, RawFilename = os.path.split(os.path.abspath(RawFile))
+    RawBasename = os.path.splitext(RawFilename)[0]
+    NightDirectory = os.path.split(RawFileDirectory)[0]
+    return os.path.join(NightDirectory, "CR2info", RawBasename+".info")
+
+
+def ParseInfo(text):
+    '''Parse the text of an info file into an InfoRecord.
+
+    If a keyword appears more than once the last value is used.
+    '''
+    values = {}
+    for line in text.split("\n"):
+        keyword, colon, value = line.partition(":")
+        if colon and keyword in InfoPatterns:
+            pattern, field, kind = InfoPatterns[keyword]
+            IsMatch = pattern.match(value)
+            if IsMatch:
+                values[field] = kind(IsMatch.group(1))
+    return InfoRecord(*[values.get(field) for field in InfoRecord._fields])
+
+
+def ReadInfo(RawFile):
+    '''Return the InfoRecord of a raw image, or None if it has no info file.
+
+    The file is only parsed again if its size or modification time changed.
+    '''
+    filename = InfoFile(RawFile)
+    try:
+        stat = os.stat(filename)
+    except OSError:
+        return None
+    cached = _cache.get(filename)
+    if cached and cached[0] == (stat.st_size, stat.st_mtime):
+        return cached[1]
+    with open(filename, 'r') as infoFO:
+        record = ParseInfo(infoFO.read())
+    _cache[filename] = ((stat.st_size, stat.st_mtime), record)
+    return record
+
+
+def SkycamHeader(RawFile):
+    '''Return a FITS header with the cards from the info file of RawFile.
+
+    MeasureImage.py passes the header to the conversion, so the working file
+    is written once with its final header:
+
+    >>> import tempfile, shutil, numpy, raw2fits
+    >>> root = tempfile.mkdtemp()
+    >>> for path in ["CR2", "CR2info"]:
+    ...     os.makedirs(os.path.join(root, "2014-01-31", path))
+    >>> RawFile = os.path.join(root, "2014-01-31", "CR2", "IMG0_0001.CR2")
+    >>> open(RawFile, 'wb').close()
+    >>> with open(InfoFile(RawFile), 'w') as infoFO:
+    ...     _ = infoFO.write("IMTYPE: OBJECT\\nTARGETDESCRIPTION: M42\\n"
+    ...                      "SHUTTER: 30.0 sec\\nUT_START: 6.5 hr\\n")
+    >>> FitsFile = os.path.join(root, "IMG0_0001.fits")
+    >>> raw2fits.WriteFITS(numpy.zeros((4, 4), numpy.uint16), FitsFile,
+    ...                    header=SkycamHeader(RawFile))
+    >>> header = fits.getheader(FitsFile)
+    >>> header['OBJECT'], header['EXPTIME'], header['DATE-OBS']
+    ('M42', 30.0, '2014-01-31T06:30:00.0')
+    >>> sorted(os.listdir(root))
+    ['2014-01-31', 'IMG0_0001.fits']
+    >>> shutil.rmtree(root)
+    '''
+    if not os.path.exists(RawFile):
+        raise IOError("Unable to find input file: %s" % RawFile)
+    DataNightString = os.path.split(os.path.split(os.path.split(os.path.abspath(RawFile))[0])[0])[1]
+    info = ReadInfo(RawFile)
+    if info is None:
+        raise IOError("Unable to find info file: %s" % InfoFile(RawFile))
+
+    header = fits.Header()
+    if info.target is not None: header['OBJECT'] = info.target
+    if info.exptime is not None: header['EXPTIME'] = info.exptime
+    if info.ra is not None:
+        RAdecimalhours = info.ra/15.
+        RAh = int(math.floor(RAdecimalhours))
+        RAm = int(math.floor((RAdecimalhours - RAh)*60.))
+        RAs = ((RAdecimalhours - RAh)*60. - RAm)*60.
+        header['RA'] = "{:02d}:{:02d}:{:04.1f}".format(RAh, RAm, RAs)
+    if info.dec is not None:
+        DECdecimal = info.dec
+        DECd = int(math.floor(DECdecimal))
+        DECm = int(math.floor((DECdecimal - DECd)*60.))
+        DECs = ((DECdecimal - DECd)*60. - DECm)*60.
+        header['DEC'] = "{:02d}:{:02d}:{:04.1f}".format(DECd, DECm, DECs)
+    if info.utstart is not None:
+        UTdecimal = info.utstart
+        UTh = int(math.floor(UTdecimal))
+        UTm = int(math.floor((UTdecimal - UTh)*60.))
+        UTs = ((UTdecimal - UTh)*60. - UTm)*60.
+        dateObs = "{}T{:02d}:{:02d}:{:04.1f}".format(DataNightString, UTh, UTm, UTs)
+        header['DATE-OBS'] = dateObs
+    header['LAT-OBS'] = 19.53602
+    header['LONG-OBS'] = -155.57608
+    header['ALT-OBS'] = 3400
+    return header
+
+
+class NightIndex(object):
+    '''Index of the info files in the CR2info directory of one night.
+
+    The index is stored as JSON in the directory and updated incrementally:
+    Update only parses the info files which are new or changed since they
+    were last indexed.  If the directory is not writable the index is kept
+    in memory only.
+    '''
+    def __init__(self, InfoDirectory):
+        self.directory = InfoDirectory
+        self.filename = os.path.join(InfoDirectory, IndexFileName)
+        self.entries = {}
+        try:
+            with open(self.filename, 'r') as indexFO:
+                self.entries = json.load(indexFO)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def Update(self):
+        '''Index new and changed info files, drop deleted ones and save.'''
+        changed = False
+        names = set()
+        for File in os.listdir(self.directory):
+            if not File.endswith(".info"):
+                continue
+            names.add(File)
+            try:
+                stat = os.stat(os.path.join(self.directory, File))
+            except OSError:
+                continue
+            entry = self.entries.get(File)
+            if entry and entry["size"] == stat.st_size and entry["mtime"] == stat.st_mtime:
+                continue
+            with open(os.path.join(self.directory, File), 'r') as infoFO:
+                record = ParseInfo(infoFO.read())
+            self.entries[File] = {"size": stat.st_size, "mtime": stat.st_mtime,
+                                  "record": record._asdict()}
+            changed = True
+        for File in set(self.entries) - names:
+            del self.entries[File]
+            changed = True
+        if changed:
+            self.Save()
+        return self
+
+    def Save(self):
+        TempFile = self.filename + ".tmp"
+        try:
+            with open(TempFile, 'w') as indexFO:
+                json.dump(self.entries, indexFO)
+            os.rename(TempFile, self.filename)
+        except (IOError, OSError):
+            pass
+
+    def Record(self, RawFile):
+        '''Return the InfoRecord of a raw image, or None if it is not indexed.'''
+        entry = self.entries.get(os.path.basename(InfoFile(RawFile)))
+        if not entry:
+            return None
+        return InfoRecord(**entry["record"])
+
+    def Select(self, imtype="OBJECT"):
+        '''Return the sorted basenames of the info files with this IMTYPE.'''
+        return sorted([File for File, entry in self.entries.items()
+                       if entry["record"]["imtype"] == imtype])
@@ -0,0 +1,123 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+StageMetrics.py
+
+Timing of the stages of the image analysis pipeline.  MeasureImage.py times
+each stage of one frame with a StageTimer, and Monitor.py collects the
+timings of all frames in rolling histograms with StageMetrics.
+"""
+
+from __future__ import division, print_function
+
+import os
+import time
+import json
+import threading
+from collections import OrderedDict, deque
+
+
+## Upper edges of the histogram bins in seconds
+DefaultBuckets = [0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300, 600]
+
+
+class StageTimer(object):
+    '''Record the time taken by each stage of processing one frame.
+
+    Call Mark with the name of each stage as it finishes.  Each stage is
+    timed from the end of the previous stage, or from the creation of the
+    timer for the first stage.
+
+    If directory is given, the size of each file in it is also recorded at
+    every Mark, and BytesWritten returns the total of the largest size seen
+    for each file.  Files which are created and deleted within one stage are
+    not counted.
+    '''
+    def __init__(self, directory=None):
+        self.start = time.time()
+        self.last = self.start
+        self.stages = OrderedDict()
+        self.directory = directory
+        self.sizes = {}
+
+    def Mark(self, stage):
+        now = time.time()
+        self.stages[stage] = self.stages.get(stage, 0.) + now - self.last
+        self.last = now
+        if self.directory:
+            for root, directories, files in os.walk(self.directory):
+                for File in files:
+                    path = os.path.join(root, File)
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                    self.sizes[path] = max(size, self.sizes.get(path, 0))
+
+    def Milestone(self, name):
+        '''Record the time from the start of the timer as if it were a stage.'''
+        self.stages[name] = time.time() - self.start
+
+    def BytesWritten(self):
+        return sum(self.sizes.values())
+
+
+class StageMetrics(object):
+    '''Rolling latency histograms of each stage over the last window frames.
+
+    After each frame the histograms are written as a Prometheus textfile
+    (for the node exporter textfile collector) to prometheusFile, and the
+    timings of the frame are appended as one JSON line to jsonFile.  Either
+    file may be None.
+    '''
+    def __init__(self, prometheusFile=None, jsonFile=None, window=200,
+                 buckets=DefaultBuckets):
+        self.prometheusFile = prometheusFile
+        self.jsonFile = jsonFile
+        self.window = window
+        self.buckets = buckets
+        self.samples = OrderedDict()
+        self.lock = threading.Lock()
+
+    def Observe(self, RawFile, stages):
+        '''Add the timings of one frame, given as a dict of stage: seconds.'''
+        with self.lock:
+            for stage, seconds in stages.items():
+                if stage not in self.samples:
+                    self.samples[stage] = deque(maxlen=self.window)
+                self.samples[stage].append(seconds)
+            if self.jsonFile:
+                record = OrderedDict([("time", time.time()), ("filename", RawFile),
+                                      ("stages", stages)])
+                with open(self.jsonFile, 'a') as jsonFO:
+                    jsonFO.write(json.dumps(record)+"\n")
+            if self.prometheusFile:
+                self.WritePrometheus()
+
+    def Quantile(self, stage, fraction):
+        values = sorted(self.samples[stage])
+        return values[min(int(fraction*len(values)), len(values)-1)]
+
+    def WritePrometheus(self):
+        '''Write the histograms as a Prometheus textfile.
+
+        The file is written to a temporary name and renamed, so the collector
+        never reads a partial file.  As the histograms only cover the last
+        window frames they are exported as gauges.
+        '''
+        lines = ["# HELP iqmon_stage_seconds_window Stage latency over the last {} frames.".format(self.window),
+                 "# TYPE iqmon_stage_seconds_window gauge"]
+        for stage, values in self.samples.items():
+            for edge in self.buckets:
+                count = len([value for value in values if value <= edge])
+                lines.append('iqmon_stage_seconds_window_bucket{{stage="{}",le="{}"}} {}'.format(stage, edge, count))
+            lines.append('iqmon_stage_seconds_window_bucket{{stage="{}",le="+Inf"}} {}'.format(stage, len(values)))
+            lines.append('iqmon_stage_seconds_window_sum{{stage="{}"}} {:.3f}'.format(stage, sum(values)))
+            lines.append('iqmon_stage_seconds_window_count{{stage="{}"}} {}'.format(stage, len(values)))
+            for fraction in [0.5, 0.9]:
+                lines.append('iqmon_stage_seconds_window_quantile{{stage="{}",quantile="{}"}} {:.3f}'.format(\
+                             stage, fraction, self.Quantile(stage, fraction)))
+        TempFile = self.prometheusFile + ".tmp"
+        with open(TempFile, 'w') as promFO:
+            promFO.write("\n".join(lines)+"\n")
+        os.rename(TempFile, self.prometheusFile)
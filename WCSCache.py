@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# encoding: utf-8
+"""
+WCSCache.py
+
+Astrometric solutions of recent frames, so that MeasureImage.py can reuse the
+solution of an earlier frame taken at the same pointing instead of solving
+every frame.
+"""
+
+from __future__ import division, print_function
+
+import os
+import sqlite3
+import threading
+
+import numpy as np
+import astropy.io.fits as fits
+import astropy.wcs as wcs
+
+
+## Name of the cache in the IQMon log directory
+WCSCacheFileName = "WCSCache.sqlite"
+
+## Keywords written by astropy.wcs which are not part of the solution
+TimeKeywords = ["DATE-OBS", "DATE-BEG", "DATE-AVG", "DATE-END", "DATEREF",
+                "MJD-OBS", "MJD-BEG", "MJD-AVG", "MJD-END", "MJDREF"]
+
+
+def StarPositions(table, nStars=30):
+    '''Return the pixel positions of the brightest stars in a SExtractor table.
+
+    Returns an array of shape (n, 2), which is empty if the table does not
+    have the XWIN_IMAGE and YWIN_IMAGE columns.
+    '''
+    try:
+        positions = np.array([table['XWIN_IMAGE'], table['YWIN_IMAGE']], dtype=float).T
+        if 'MAG_AUTO' in table.colnames:
+            positions = positions[np.argsort(np.array(table['MAG_AUTO']))]
+    except:
+        return np.zeros((0, 2))
+    return positions[:nStars]
+
+
+def MatchFraction(reference, stars, tolerance=3.0):
+    '''Return the fraction of reference positions with a star within tolerance pixels.'''
+    if len(reference) == 0 or len(stars) == 0:
+        return 0.
+    distance = np.hypot(reference[:,0,None] - stars[None,:,0],
+                        reference[:,1,None] - stars[None,:,1])
+    return np.mean(distance.min(axis=1) <= tolerance)
+
+
+class WCSCache(object):
+    '''SQLite table of astrometric solutions keyed by pointing and time.
+
+    Each solution is stored with the telescope, the region of the raw image
+    which was analyzed, the target and commanded RA and Dec from the info
+    file, the time of the observation, and the positions of the brightest
+    stars detected in the frame.  A solution is reused for a frame with the
+    same telescope, region and target, commanded within tolerance degrees and
+    taken within maxAge seconds, if at least minMatch of its stars are found
+    again within a few pixels.
+    '''
+    def __init__(self, filename, tolerance=0.05, maxAge=1800,
+                 minMatch=0.5, minStars=5):
+        self.filename = filename
+        self.tolerance = tolerance
+        self.maxAge = maxAge
+        self.minMatch = minMatch
+        self.minStars = minStars
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(filename, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute('''CREATE TABLE IF NOT EXISTS solutions (
+                                       telescope TEXT,
+                                       region TEXT,
+                                       target TEXT,
+                                       ra REAL,
+                                       dec REAL,
+                                       obstime REAL,
+                                       header TEXT,
+                                       stars BLOB)''')
+
+    def Lookup(self, telescope, region, target, ra, dec, obstime):
+        '''Return the closest solution in time as (header, stars), or None.'''
+        if ra is None or dec is None or obstime is None:
+            return None
+        with self.lock:
+            row = self.connection.execute('''SELECT header, stars FROM solutions
+                                             WHERE telescope = ? AND region = ? AND target IS ?
+                                             AND abs(ra - ?) <= ? AND abs(dec - ?) <= ?
+                                             AND abs(obstime - ?) <= ?
+                                             ORDER BY abs(obstime - ?) LIMIT 1''',
+                                          (telescope, region, target, ra, self.tolerance,
+                                           dec, self.tolerance, obstime, self.maxAge,
+                                           obstime)).fetchone()
+        if not row:
+            return None
+        header = fits.Header.fromstring(row[0])
+        stars = np.frombuffer(row[1], dtype=float).reshape(-1, 2)
+        return header, stars
+
+    def Verify(self, stars, cached):
+        '''Return True if the stars of a frame match those of a cached solution.'''
+        reference = cached[1]
+        if len(reference) < self.minStars:
+            return False
+        return MatchFraction(reference, stars) >= self.minMatch
+
+    def Store(self, telescope, region, target, ra, dec, obstime, FitsFile, stars):
+        '''Add the solution in the header of FitsFile to the cache.
+
+        Solutions observed more than a day before obstime are removed.
+        '''
+        if ra is None or dec is None or obstime is None:
+            return
+        solution = wcs.WCS(fits.getheader(FitsFile))
+        if not solution.has_celestial:
+            return
+        header = solution.to_header(relax=True)
+        ## Times belong to the solved frame, not to the frames reusing it
+        for keyword in TimeKeywords:
+            header.remove(keyword, ignore_missing=True, remove_all=True)
+        with self.lock, self.connection:
+            self.connection.execute('''INSERT INTO solutions VALUES (?, ?, ?, ?, ?, ?, ?, ?)''',
+                                    (telescope, region, target, ra, dec, obstime,
+                                     header.tostring(),
+                                     sqlite3.Binary(np.ascontiguousarray(stars, dtype=float).tobytes())))
+            self.connection.execute("DELETE FROM solutions WHERE obstime < ?", (obstime - 86400, ))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
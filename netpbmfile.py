@@ -38,6 +38,8 @@ http://netpbm.sourceforge.net/doc/. No gamma correction is performed.
 
 The following image formats are supported: PBM (bi-level), PGM (grayscale),
 PPM (color), PAM (arbitrary), XV thumbnail (RGB332, read-only).
+PAM files can also be written incrementally, frame by frame or in blocks
+of rows.
 
 :Author:
   `Christoph Gohlke <http://www.lfd.uci.edu/~gohlke/>`_
@@ -59,6 +61,45 @@ Examples
 >>> imsave('_tmp.pgm', im1)
 >>> im2 = imread('_tmp.pgm')
 >>> assert numpy.all(im1 == im2)
+>>> strips = list(NetpbmFile('_tmp.pgm').iter_rows(chunk_rows=1))
+>>> assert numpy.all(numpy.vstack(strips) == im1)
+>>> with open('_tmp.pgm', 'wb') as fh:
+...     _ = fh.write(b'P2 2 2 65535\\n0 1\\n65534 65535\\n')
+>>> assert numpy.all(imread('_tmp.pgm') == im1)
+>>> with open('_tmp.pgm', 'wb') as fh:
+...     _ = fh.write(b'P2\\n# comment\\n3 2\\n255\\n0 1 2\\n253 254 255\\n')
+>>> imread('_tmp.pgm')
+array([[  0,   1,   2],
+       [253, 254, 255]], dtype=uint8)
+>>> with open('_tmp_short.pgm', 'wb') as fh:
+...     _ = fh.write(b'P2 3 2 255\\n0 1 2\\n253\\n')
+>>> imread('_tmp_short.pgm')
+Traceback (most recent call last):
+ ...
+ValueError: expected 6 values, found 4
+>>> data = b'P2 3 2 255\\n0 1 2\\n253 254 255\\n# end\\n\\0\\0'
+>>> with open('_tmp_trailing.pgm', 'wb') as fh:
+...     _ = fh.write(data)
+>>> netpbm = NetpbmFile('_tmp_trailing.pgm')
+>>> samples = data[len(netpbm.header):].split(None, 6)[:6]
+>>> netpbm.close()
+>>> old = numpy.array(samples, 'u1').reshape(2, 3)
+>>> assert numpy.all(imread('_tmp_trailing.pgm') == old)
+>>> with open('_tmp.pbm', 'wb') as fh:
+...     _ = fh.write(b'P1\\n3 2\\n0 1 0\\n110\\n')
+>>> imread('_tmp.pbm')
+array([[0, 1, 0],
+       [1, 1, 0]], dtype=uint8)
+>>> with open('_tmp.ppm', 'wb') as fh:
+...     _ = fh.write(b'P3 2 1 65535\\n0 1 2 65533 65534 65535\\n')
+>>> imread('_tmp.ppm')
+array([[[    0,     1,     2],
+        [65533, 65534, 65535]]], dtype='>u2')
+>>> with open('_tmp.ppm', 'wb') as fh:
+...     _ = fh.write(b'P3 2 1 255\\n0 1 2 253 254 255\\n')
+>>> imread('_tmp.ppm')
+array([[[  0,   1,   2],
+        [253, 254, 255]]], dtype=uint8)
 
 """
 
@@ -73,7 +114,7 @@ import numpy
 
 __version__ = '2013.01.18'
 __docformat__ = 'restructuredtext en'
-__all__ = ['imread', 'imsave', 'NetpbmFile']
+__all__ = ['imread', 'imsave', 'NetpbmFile', 'PamWriter']
 
 
 def imread(filename, *args, **kwargs):
@@ -84,11 +125,12 @@ def imread(filename, *args, **kwargs):
     Examples
     --------
     >>> image = imread('_tmp.pgm')
+    >>> image = imread('_tmp.pgm', mmap=True)
 
     """
     try:
         netpbm = NetpbmFile(filename)
-        image = netpbm.asarray()
+        image = netpbm.asarray(*args, **kwargs)
     finally:
         netpbm.close()
     return image
@@ -135,7 +177,11 @@ class NetpbmFile(object):
             self._fromdata(arg, **kwargs)
 
     def asarray(self, copy=True, cache=False, **kwargs):
-        """Return image data from file as numpy array."""
+        """Return image data from file as numpy array.
+
+        `kwargs` are arguments to _read_data(), e.g. `byteorder` or `mmap`.
+
+        """
         data = self._data
         if data is None:
             data = self._read_data(self._fh, **kwargs)
@@ -145,6 +191,44 @@ class NetpbmFile(object):
                 return data
         return deepcopy(data) if copy else data
 
+    def iter_rows(self, chunk_rows=256, byteorder='>'):
+        """Return iterator over strips of image data read from open file.
+
+        Each strip is a numpy array of at most `chunk_rows` rows. Only binary
+        data can be streamed. The frames of multi-frame PAM files are
+        returned one after another; a strip never spans two frames.
+
+        """
+        if self._fh is None or self.magicnum in b"P1P2P3":
+            raise ValueError("can not stream rows of %s" % self.magicnum)
+        dtype = numpy.dtype('u1' if self.maxval < 256 else byteorder + 'u2')
+        depth = 1 if self.magicnum == b"P7 332" else self.depth
+        if self.maxval == 1:
+            rowsize = int(math.ceil(self.width / 8)) * depth
+        else:
+            rowsize = self.width * depth * dtype.itemsize
+        if self.magicnum == b"P7 332":
+            rgb332 = numpy.array(list(numpy.ndindex(8, 8, 4)), numpy.uint8)
+            rgb332 *= [36, 36, 85]
+        if not self.height or not rowsize:
+            return
+        fh = self._fh
+        fh.seek(len(self.header))
+        while True:
+            for row in range(0, self.height, chunk_rows):
+                nrows = min(chunk_rows, self.height - row)
+                data = fh.read(nrows * rowsize)
+                if len(data) < nrows * rowsize:
+                    return
+                data = numpy.frombuffer(data, dtype).reshape(nrows, -1, depth)
+                if self.maxval == 1:
+                    data = numpy.unpackbits(data, axis=-2)[:, :self.width, :]
+                if depth < 2:
+                    data = data.reshape(data.shape[:-1])
+                if self.magicnum == b"P7 332":
+                    data = numpy.take(rgb332, data, axis=0)
+                yield data
+
     def write(self, arg, **kwargs):
         """Write instance to file."""
         if hasattr(arg, 'seek'):
@@ -206,17 +290,41 @@ class NetpbmFile(object):
         self.depth = 3 if self.magicnum in b"P3P6P7 332" else 1
         self.tupltypes = [self._types[self.magicnum]]
 
-    def _read_data(self, fh, byteorder='>'):
-        """Return image data from open file as numpy array."""
-        fh.seek(len(self.header))
-        data = fh.read()
+    def _read_data(self, fh, byteorder='>', mmap=False):
+        """Return image data from open file as numpy array.
+
+        If `mmap` is True, binary PAM, PGM and PPM data are returned as a
+        read-only view of a numpy.memmap instead of being read into memory.
+        This requires a real file, not a pipe or in-memory stream.
+
+        """
         dtype = 'u1' if self.maxval < 256 else byteorder + 'u2'
         depth = 1 if self.magicnum == b"P7 332" else self.depth
         shape = [-1, self.height, self.width, depth]
         size = numpy.prod(shape[1:])
+        if mmap and self.maxval > 1 and self.magicnum not in b"P1P2P3":
+            data = numpy.memmap(fh, dtype, mode='r', offset=len(self.header))
+        else:
+            fh.seek(len(self.header))
+            data = fh.read()
+        if self.magicnum == b"P1":
+            # samples of plain PBM need not be separated by whitespace
+            data = numpy.frombuffer(data, 'u1')
+            data = data[(data == 48) | (data == 49)] - 48
+        elif self.magicnum in b"P2P3":
+            # parse only the first size samples, ignore anything after them
+            chars = numpy.frombuffer(data, 'u1')
+            space = (chars == 32) | ((chars >= 9) & (chars <= 13))
+            after_space = numpy.ones_like(space)
+            after_space[1:] = space[:-1]
+            starts = numpy.flatnonzero(~space & after_space)
+            if starts.size > size:
+                data = data[:starts[size]]
+            data = numpy.fromstring(data, 'u2', sep=' ')
         if self.magicnum in b"P1P2P3":
-            data = numpy.array(data.split(None, size)[:size], dtype)
-            data = data.reshape(shape)
+            if data.size < size:
+                raise ValueError("expected %i values, found %i" % (size, data.size))
+            data = data[:size].astype(dtype).reshape(shape)
         elif self.maxval == 1:
             shape[2] = int(math.ceil(self.width / 8))
             data = numpy.frombuffer(data, dtype).reshape(shape)
@@ -246,7 +354,7 @@ class NetpbmFile(object):
             maxval = 255 if maxval < 256 else 65535
         if maxval < 0 or maxval > 65535:
             raise ValueError("data out of range: %i" % maxval)
-        data = data.astype('u1' if maxval < 256 else '>u2')
+        data = data.astype('u1' if maxval < 256 else '>u2', copy=False)
         self._data = data
         if data.ndim > 2 and data.shape[-1] in (3, 4):
             self.depth = data.shape[-1]
@@ -297,6 +405,104 @@ class NetpbmFile(object):
         return unicode(self.header)
 
 
+class PamWriter(object):
+    """Write PAM file incrementally, one frame or block of rows at a time.
+
+    The header is written once when the file is opened. Its HEIGHT is
+    updated when the file is closed: if `height` is None, all rows written
+    form a single image, else they form a sequence of frames of `height`
+    rows each, and an incomplete last frame is ignored by readers.
+    Contiguous data in the file's byte order are written without copying.
+
+    Examples
+    --------
+    >>> image = numpy.array([[0, 1],[65534, 65535]], dtype=numpy.uint16)
+    >>> with PamWriter('_tmp.pam', width=2, maxval=65535) as pam:
+    ...     pam.write(image[:1])
+    ...     pam.write(image[1:])
+    >>> assert numpy.all(imread('_tmp.pam') == image)
+
+    """
+
+    _types = {1: b'GRAYSCALE', 2: b'GRAYSCALE_ALPHA', 3: b'RGB',
+              4: b'RGB_ALPHA'}
+
+    def __init__(self, arg, width, depth=1, maxval=255, height=None,
+                 tupltypes=None):
+        """Open file for writing and write header."""
+        self._fh = None
+        if maxval < 1 or maxval > 65535:
+            raise ValueError("data out of range: %i" % maxval)
+        self.width = width
+        self.depth = depth
+        self.maxval = maxval
+        self.height = height
+        if tupltypes is None:
+            tupltypes = [b'BLACKANDWHITE' if maxval == 1 else
+                         self._types.get(depth, b'GRAYSCALE')]
+        self.tupltypes = tupltypes
+        self.rows = 0
+        self._dtype = numpy.dtype('u1' if maxval < 256 else '>u2')
+        self._filename = None
+        if hasattr(arg, 'seek'):
+            self._fh = arg
+        else:
+            self._fh = open(arg, 'wb')
+            self._filename = arg
+        self._fh.seek(0)
+        self._fh.write(self._header())
+
+    def write(self, data):
+        """Append frames or rows of image data to file."""
+        data = numpy.asarray(data)
+        shape = (self.width, ) if self.depth == 1 else (self.width,
+                                                         self.depth)
+        if data.shape[-len(shape):] != shape:
+            raise ValueError("data shape does not match: %s" % (data.shape, ))
+        if data.dtype != self._dtype:
+            data = data.astype(self._dtype)
+        rows = data.size // (self.width * self.depth)
+        if self.maxval == 1:
+            data = numpy.packbits(data, axis=-1)
+        numpy.ascontiguousarray(data).tofile(self._fh)
+        self.rows += rows
+
+    def close(self):
+        """Write final HEIGHT to header and close file."""
+        if self._fh is None:
+            return
+        self._fh.seek(0)
+        self._fh.write(self._header())
+        self._fh.seek(0, 2)
+        if self._filename:
+            self._fh.close()
+        self._fh = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        self.close()
+
+    def _header(self):
+        """Return file header with fixed width HEIGHT field as byte string."""
+        height = self.rows if self.height is None else self.height
+        header = "\n".join((
+            "P7",
+            "HEIGHT %10i" % height,
+            "WIDTH %i" % self.width,
+            "DEPTH %i" % self.depth,
+            "MAXVAL %i" % self.maxval,
+            "\n".join("TUPLTYPE %s" % unicode(i) for i in self.tupltypes),
+            "ENDHDR\n"))
+        if sys.version_info[0] > 2:
+            header = bytes(header, 'ascii')
+        return header
+
+
 if sys.version_info[0] > 2:
     basestring = str
     unicode = lambda x: str(x, 'ascii')
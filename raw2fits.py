@@ -8,11 +8,344 @@ import os
 import argparse
 import logging
 import re
+import io
+import glob
+import time
+import multiprocessing
+import functools
+import tempfile
+import shutil
 import numpy as np
 import subprocess
 import netpbmfile
 import astropy.io.fits as fits
 
+##-------------------------------------------------------------------------
+## Read CR2 File Using dcraw
+##-------------------------------------------------------------------------
+def ReadCR2(RawFile, logger, ppmfile=None, document=False):
+    '''Convert a CR2 file with dcraw and return the image as a numpy array.
+
+    The output of dcraw is read through a pipe, so no intermediate PPM file is
+    written.  If ppmfile is given it is used as a cache:  an existing file is
+    read instead of calling dcraw, otherwise the output of dcraw is saved to it
+    under a temporary name and renamed, so an interrupted write is not reused.
+    If document is True, dcraw returns the raw CFA mosaic without demosaicing.
+    '''
+    if ppmfile and os.path.exists(ppmfile):
+        logger.info("PPM file already exists, using that file.")
+        return netpbmfile.NetpbmFile(ppmfile).asarray(mmap=True)
+    dcrawCommand = ["dcraw", "-D", "-4", "-c", RawFile] if document else\
+                   ["dcraw", "-4", "-c", RawFile]
+    logger.info("Calling dcraw using: {0}".format(repr(dcrawCommand)))
+    dcraw = subprocess.Popen(dcrawCommand, stdout=subprocess.PIPE)
+    ppmdata = dcraw.communicate()[0]
+    if dcraw.returncode != 0:
+        raise subprocess.CalledProcessError(dcraw.returncode, dcrawCommand)
+    if ppmfile:
+        logger.info("Writing PPM file: {0}".format(ppmfile))
+        tmpFile = ppmfile + ".tmp"
+        with open(tmpFile, 'wb') as ppmFO:
+            ppmFO.write(ppmdata)
+        os.rename(tmpFile, ppmfile)
+    return netpbmfile.NetpbmFile(io.BytesIO(ppmdata)).asarray()
+
+
+##-------------------------------------------------------------------------
+## Read CR2 Header Information Using dcraw
+##-------------------------------------------------------------------------
+def ReadCR2Header(RawFile, logger):
+    '''Return a FITS header built from the dcraw description of a CR2 file.'''
+    header = fits.Header()
+    dcrawGetInfoCommand = ["dcraw", "-i", "-v", RawFile]
+    logger.debug("Calling dcraw using: {0}".format(repr(dcrawGetInfoCommand)))
+    try:
+        dcrawInfo = subprocess.check_output(dcrawGetInfoCommand, universal_newlines=True)
+    except:
+        logger.warning("Could not get dcraw info from file.")
+        return header
+    for line in dcrawInfo.split("\n"):
+        IsCAMERA = re.match("Camera:\s*(.+)", line)
+        if IsCAMERA: header['INSTRUME'] = IsCAMERA.group(1).strip()
+        IsISO = re.match("ISO speed:\s*(\d+)", line)
+        if IsISO: header['ISO'] = int(IsISO.group(1))
+        IsEXPTIME = re.match("Shutter:\s*(1/)?(\d+\.?\d*)\s*sec", line)
+        if IsEXPTIME:
+            exptime = float(IsEXPTIME.group(2))
+            header['EXPTIME'] = 1./exptime if IsEXPTIME.group(1) else exptime
+    return header
+
+
+##-------------------------------------------------------------------------
+## Extract Green Planes from Raw CFA Image
+##-------------------------------------------------------------------------
+def GreenPlanes(cfa, pattern="RGGB"):
+    '''Return strided views of the two green planes of a raw Bayer image.
+
+    pattern gives the colors of the top left 2x2 Bayer cell in row order.
+    The two planes are trimmed to a common shape.
+    '''
+    offsets = [divmod(i, 2) for i, color in enumerate(pattern[:4]) if color == "G"]
+    if len(offsets) != 2:
+        raise ValueError("Bayer pattern {0} does not have two green pixels".format(pattern))
+    planes = [cfa[y::2, x::2] for y, x in offsets]
+    ny = min([plane.shape[0] for plane in planes])
+    nx = min([plane.shape[1] for plane in planes])
+    return [plane[:ny, :nx] for plane in planes]
+
+
+##-------------------------------------------------------------------------
+## Convert CR2 File to Image Array
+##-------------------------------------------------------------------------
+def ConvertCR2(RawFile, logger, green=None, pattern="RGGB", ppmfile=None):
+    '''Return the image data of a CR2 file as a numpy array.
+
+    By default this is the demosaiced RGB image.  If green is "average", "g1"
+    or "g2", the raw CFA mosaic is read instead and the average of the two
+    green planes, or one of them, is returned as a half resolution image.
+    '''
+    if not green:
+        return ReadCR2(RawFile, logger, ppmfile=ppmfile)
+    g1, g2 = GreenPlanes(ReadCR2(RawFile, logger, ppmfile=ppmfile, document=True), pattern)
+    if green == "g1":
+        return g1
+    elif green == "g2":
+        return g2
+    elif green == "average":
+        return (g1.astype(np.float32) + g2) / 2.
+    else:
+        raise ValueError("Unknown green channel mode: {0}".format(green))
+
+
+##-------------------------------------------------------------------------
+## Convert CR2 File to Green Channel Image and Header
+##-------------------------------------------------------------------------
+def GreenChannel(RawFile, logger, ppmfile=None):
+    '''Return the full resolution green channel of a CR2 file and its header.
+
+    This is the in-process equivalent of the CR2toFITSg program.  The header
+    holds the cards from ReadCR2Header.
+    '''
+    header = ReadCR2Header(RawFile, logger)
+    im = ReadCR2(RawFile, logger, ppmfile=ppmfile)
+    return im[:,:,1], header
+
+
+def ROISlices(ROI):
+    '''Return the array slices of an ROI given as "[x1:x2,y1:y2]".
+
+    The ROI uses 1 based, inclusive pixel coordinates like IQMon's tel.ROI.
+    '''
+    IsROI = re.match("\[(\d+):(\d+),(\d+):(\d+)\]", ROI.replace(" ", ""))
+    if not IsROI:
+        raise ValueError("Could not parse ROI: {}".format(ROI))
+    x1, x2, y1, y2 = [int(value) for value in IsROI.groups()]
+    return slice(y1-1, y2), slice(x1-1, x2)
+
+
+def WriteGreenFITS(RawFile, FitsFile, logger, header=None, ROI=None):
+    '''Write the green channel of a CR2 file to FitsFile in one pass.
+
+    The cards in header are added to those read from the raw file, replacing
+    any with the same keyword, and if ROI is given the image is cropped to
+    it in memory, so the file is written once with its final header and
+    never opened again to update it:
+
+    >>> import logging
+    >>> root = tempfile.mkdtemp()
+    >>> with open(os.path.join(root, "image.ppm"), 'wb') as ppmFO:
+    ...     _ = ppmFO.write(b"P6 3 2 65535\\n" + np.arange(18, dtype='>u2').tobytes())
+    >>> with open(os.path.join(root, "dcraw"), 'w') as dcrawFO:
+    ...     _ = dcrawFO.write('#!/bin/sh\\n[ "$1" = "-i" ] && echo "ISO speed: 100" '
+    ...                       '|| cat {}\\n'.format(os.path.join(root, "image.ppm")))
+    >>> os.chmod(os.path.join(root, "dcraw"), 0o755)
+    >>> os.environ['PATH'] = root + os.pathsep + os.environ['PATH']
+    >>> modes = []
+    >>> fitsopen = fits.open
+    >>> fits.open = lambda *args, **kwargs: modes.append(kwargs.get('mode')) or fitsopen(*args, **kwargs)
+    >>> FitsFile = os.path.join(root, "image.fits")
+    >>> WriteGreenFITS("image.CR2", FitsFile, logging.getLogger("raw2fits"),
+    ...                header=fits.Header([('OBJECT', 'M42'), ('CTYPE1', 'RA---TAN')]),
+    ...                ROI="[2:3,1:2]")
+    >>> stat = os.stat(FitsFile)
+    >>> header = fits.getheader(FitsFile)
+    >>> header['ISO'], header['OBJECT'], header['CTYPE1'], header['ROI']
+    (100, 'M42', 'RA---TAN', '[2:3,1:2]')
+    >>> fits.getdata(FitsFile).tolist()
+    [[4, 7], [13, 16]]
+    >>> 'update' in modes
+    False
+    >>> (os.stat(FitsFile).st_ino, os.stat(FitsFile).st_mtime) == (stat.st_ino, stat.st_mtime)
+    True
+    >>> fits.open = fitsopen
+    >>> os.environ['PATH'] = os.environ['PATH'].split(os.pathsep, 1)[1]
+    >>> shutil.rmtree(root)
+    '''
+    green, CR2header = GreenChannel(RawFile, logger)
+    if header is not None:
+        CR2header.extend(header.cards, update=True)
+    if ROI:
+        green = green[ROISlices(ROI)]
+        CR2header['ROI'] = (ROI, 'Region of the raw image in this file')
+    WriteFITS(green, FitsFile, header=CR2header)
+
+
+##-------------------------------------------------------------------------
+## Tile Compression Options
+##-------------------------------------------------------------------------
+def CompressionOptions(compression_type, tile=None, quantize_level=16.):
+    '''Return the CompImageHDU arguments used by WriteFITS for compression.
+
+    tile is a string giving the tile shape in pixels as "ny,nx".  By default
+    each image row is one tile.  quantize_level only applies to float data,
+    integer data are always compressed losslessly.
+    '''
+    compression = {'compression_type': compression_type,
+                   'quantize_level': quantize_level}
+    if tile:
+        compression['tile_shape'] = tuple([int(n) for n in tile.split(",")])
+    return compression
+
+
+##-------------------------------------------------------------------------
+## Write FITS File
+##-------------------------------------------------------------------------
+def WriteFITS(im, FitsFile, header=None, compression=None):
+    '''Write im to a FITS file.
+
+    A two dimensional image is written to the primary HDU.  For an RGB image
+    the red, green and blue channels are written as separate extensions.
+    header, if given, is used for the primary HDU.  If compression is given
+    (see CompressionOptions), the image data are written as tile compressed
+    extensions and the primary HDU only holds the header.  The file is written
+    under a temporary name and then renamed, so a partly written file never
+    appears under the final name.
+    '''
+    if compression:
+        ImageHDU = functools.partial(fits.CompImageHDU, **compression)
+    else:
+        ImageHDU = fits.ImageHDU
+    if im.ndim == 2 and not compression:
+        hdulist = fits.HDUList([fits.PrimaryHDU(im, header=header)])
+    elif im.ndim == 2:
+        phdu = fits.PrimaryHDU(header=header)
+        hdulist = fits.HDUList([phdu, ImageHDU(im)])
+    else:
+        phdu = fits.PrimaryHDU(header=header)
+        redhdu = ImageHDU(im[:,:,0])
+        greenhdu = ImageHDU(im[:,:,1])
+        bluehdu = ImageHDU(im[:,:,2])
+        hdulist = fits.HDUList([phdu, redhdu, greenhdu, bluehdu])
+    tmpFile = FitsFile+".tmp"
+    if os.path.exists(tmpFile): os.remove(tmpFile)
+    hdulist.writeto(tmpFile)
+    os.rename(tmpFile, FitsFile)
+
+
+##-------------------------------------------------------------------------
+## Compare Compressed and Uncompressed FITS Files
+##-------------------------------------------------------------------------
+def CompressionReport(im, logger, compression, directory=None):
+    '''Log write time, read time and file size with and without compression.
+
+    The test files are written to a temporary directory inside directory and
+    deleted afterwards.
+    '''
+    reportDirectory = tempfile.mkdtemp(dir=directory)
+    try:
+        logger.info("{0:>12s} {1:>8s} {2:>8s} {3:>10s}".format("Format", "Write", "Read", "Size"))
+        for name, options in [("none", None), (compression['compression_type'], compression)]:
+            FitsFile = os.path.join(reportDirectory, name+".fits")
+            startTime = time.time()
+            WriteFITS(im, FitsFile, compression=options)
+            writeTime = time.time() - startTime
+            startTime = time.time()
+            hdulist = fits.open(FitsFile, memmap=False)
+            for hdu in hdulist:
+                data = hdu.data
+            hdulist.close()
+            readTime = time.time() - startTime
+            size = os.path.getsize(FitsFile)/1024./1024.
+            logger.info("{0:>12s} {1:>7.2f}s {2:>7.2f}s {3:>7.1f} MB".format(name, writeTime, readTime, size))
+    finally:
+        shutil.rmtree(reportDirectory)
+
+
+##-------------------------------------------------------------------------
+## Convert One File in a Batch
+##-------------------------------------------------------------------------
+def ConvertWorker(job, green=None, pattern="RGGB", compression=None):
+    '''Convert a (RawFile, FitsFile, ppmfile) job in a batch worker process.
+
+    Returns the input file name and its size in bytes, or None for the size
+    if the conversion failed.
+    '''
+    RawFile, FitsFile, ppmfile = job
+    logger = logging.getLogger('MyLogger')
+    try:
+        im = ConvertCR2(RawFile, logger, green=green, pattern=pattern, ppmfile=ppmfile)
+        logger.info("Writing new fits file: {0}".format(FitsFile))
+        WriteFITS(im, FitsFile, compression=compression)
+    except:
+        logger.error("Conversion of {0} failed: {1}".format(RawFile, sys.exc_info()[1]))
+        return RawFile, None
+    return RawFile, os.path.getsize(RawFile)
+
+
+##-------------------------------------------------------------------------
+## Convert a Directory or Glob of CR2 Files
+##-------------------------------------------------------------------------
+def BatchConvert(input, logger, outputDirectory=None, jobs=1, ppmcache=False,
+                 green=None, pattern="RGGB", compression=None):
+    '''Convert all CR2 files in a directory or matching a glob pattern.
+
+    Conversions are spread over a pool of jobs processes.  Files whose FITS
+    file is newer than the CR2 file are skipped.  outputDirectory is created
+    if it does not exist.
+    '''
+    if os.path.isdir(input):
+        input = os.path.join(input, "*")
+    RawFiles = sorted([RawFile for RawFile in glob.glob(input)\
+                       if re.match("\.cr2", os.path.splitext(RawFile)[1], flags=re.I)])
+    logger.info("Found {0} CR2 files matching {1}".format(len(RawFiles), input))
+    if outputDirectory and not os.path.isdir(outputDirectory):
+        logger.info("Creating output directory {0}".format(outputDirectory))
+        os.makedirs(outputDirectory)
+    ConvertJobs = []
+    for RawFile in RawFiles:
+        RawBasename, RawExt = os.path.splitext(RawFile)
+        FitsFile = RawBasename+".fits"
+        if outputDirectory:
+            FitsFile = os.path.join(outputDirectory, os.path.basename(FitsFile))
+        if os.path.exists(FitsFile) and os.path.getmtime(FitsFile) > os.path.getmtime(RawFile):
+            logger.debug("Skipping {0}, FITS file is up to date.".format(RawFile))
+            continue
+        ppmExt = ".pgm" if green else ".ppm"
+        ppmfile = RawBasename+ppmExt if ppmcache else None
+        ConvertJobs.append((RawFile, FitsFile, ppmfile))
+    logger.info("Converting {0} files using {1} processes.".format(len(ConvertJobs), jobs))
+
+    startTime = time.time()
+    nConverted = 0
+    nBytes = 0
+    pool = multiprocessing.Pool(jobs)
+    worker = functools.partial(ConvertWorker, green=green, pattern=pattern,
+                               compression=compression)
+    for RawFile, size in pool.imap_unordered(worker, ConvertJobs):
+        if size is not None:
+            nConverted += 1
+            nBytes += size
+    pool.close()
+    pool.join()
+    elapsed = time.time() - startTime
+
+    logger.info("Converted {0} of {1} files in {2:.1f} s".format(nConverted, len(ConvertJobs), elapsed))
+    if elapsed > 0:
+        logger.info("  Throughput: {0:.2f} frames/s, {1:.1f} MB/s of CR2 input".format(\
+                    nConverted/elapsed, nBytes/1024./1024./elapsed))
+    return nConverted
+
+
 ##-------------------------------------------------------------------------
 ## Main Program
 ##-------------------------------------------------------------------------
@@ -28,13 +361,38 @@ def main():
     parser.add_argument("-v", "--verbose",
         action="store_true", dest="verbose",
         default=False, help="Be verbose! (default = False)")
+    parser.add_argument("--ppm-cache",
+        action="store_true", dest="ppmcache",
+        default=False, help="Keep the dcraw output as a PPM file next to the input and reuse it if present. (default = False)")
+    parser.add_argument("-j", "--jobs",
+        type=int, dest="jobs",
+        default=multiprocessing.cpu_count(),
+        help="Number of parallel conversions in batch mode. (default = number of CPUs)")
+    parser.add_argument("-g", "--green",
+        type=str, dest="green", choices=["average", "g1", "g2"],
+        default=None, help="Skip demosaicing and write only the average of the two green Bayer planes, or one of them, as a half resolution image. (default = write RGB)")
+    parser.add_argument("--pattern",
+        type=str, dest="pattern",
+        default="RGGB", help="Bayer pattern of the top left 2x2 pixels, used with --green. (default = RGGB)")
+    parser.add_argument("--compress",
+        type=str, dest="compress", choices=["RICE_1", "GZIP_1", "GZIP_2"],
+        default=None, help="Write tile compressed FITS using this algorithm. (default = no compression)")
+    parser.add_argument("--tile",
+        type=str, dest="tile",
+        default=None, help="Tile shape for compression as ny,nx. (default = one row per tile)")
+    parser.add_argument("--quantize",
+        type=float, dest="quantize",
+        default=16., help="Quantization level for compressing float data. (default = 16)")
+    parser.add_argument("--compression-report",
+        action="store_true", dest="compressionreport",
+        default=False, help="Compare write time, read time and size with and without compression. (default = False)")
     ## add arguments
     parser.add_argument("input",
         type=str,
-        help="The input CR2 file")
+        help="The input CR2 file, or a directory or glob of CR2 files to convert in batch mode")
     parser.add_argument("-o", "--output",
         type=str, dest="output",
-        help="The output fits file.")
+        help="The output fits file, or the output directory in batch mode.")
     args = parser.parse_args()
 
 
@@ -59,6 +417,21 @@ def main():
 #     LogFileHandler.setFormatter(LogFormat)
 #     logger.addHandler(LogFileHandler)
 
+    compression = None
+    if args.compress or args.compressionreport:
+        compression = CompressionOptions(args.compress or "RICE_1", tile=args.tile,
+                                         quantize_level=args.quantize)
+
+    ##-------------------------------------------------------------------------
+    ## Batch mode for a directory or glob of CR2 files
+    ##-------------------------------------------------------------------------
+    if os.path.isdir(args.input) or re.search("[\*\?\[]", args.input):
+        BatchConvert(args.input, logger, outputDirectory=args.output,
+                     jobs=args.jobs, ppmcache=args.ppmcache,
+                     green=args.green, pattern=args.pattern,
+                     compression=compression if args.compress else None)
+        return
+
     ##-------------------------------------------------------------------------
     ## 
     ##-------------------------------------------------------------------------
@@ -80,41 +453,31 @@ def main():
     dcrawGetInfoCommand = ["dcraw", "-i", "-v", args.input]
     logger.info("Calling dcraw using: {0}".format(repr(dcrawGetInfoCommand)))
     try:
-        dcrawInfo = subprocess.check_output(dcrawGetInfoCommand)
+        dcrawInfo = subprocess.check_output(dcrawGetInfoCommand, universal_newlines=True)
+        for line in dcrawInfo.split("\n"):
+            logger.debug(line)
     except:
         logger.error("Could not get dcraw info from file.")
-
-    for line in dcrawInfo.split("\n"):
-        logger.debug(line)
         
-    ## Use dcraw to convert cr2 to ppm
-    ppmfile = args.input.replace(inputExt, ".ppm")
-    if not os.path.exists(ppmfile):
-        dcrawCommand = "dcraw -4 -c "+args.input+" > "+ppmfile
-        logger.info("Calling dcraw using: {0}".format(dcrawCommand))
-        try:
-            os.system(dcrawCommand)
-        except:
-            logger.critical("dcraw failed")
-    else:
-        logger.info("PPM file already exists, using that file.")
-
-    logger.info("Reading PPM file.")
-    im = netpbmfile.NetpbmFile(ppmfile).asarray()
+    ## Use dcraw to convert cr2, optionally caching the ppm output
+    ppmExt = ".pgm" if args.green else ".ppm"
+    ppmfile = args.input.replace(inputExt, ppmExt) if args.ppmcache else None
+    try:
+        im = ConvertCR2(args.input, logger, green=args.green,
+                        pattern=args.pattern, ppmfile=ppmfile)
+    except:
+        logger.critical("dcraw failed")
+        sys.exit(1)
     
+    if args.compressionreport:
+        CompressionReport(im, logger, compression,
+                          directory=os.path.dirname(os.path.abspath(args.output)))
+
     logger.info("Writing new fits file: {0}".format(args.output))
-    if os.path.exists(args.output): os.remove(args.output)
-    phdu = fits.PrimaryHDU()
-    redhdu = fits.ImageHDU(im[:,:,0])
-    greenhdu = fits.ImageHDU(im[:,:,1])
-    bluehdu = fits.ImageHDU(im[:,:,2])
-    hdulist = fits.HDUList([phdu, redhdu, greenhdu, bluehdu])
-    hdulist.writeto(args.output)
-    
+    WriteFITS(im, args.output, compression=compression if args.compress else None)
+
 
 
-#     hdu = fits.PrimaryHDU(green)
-#     hdu.writeto('GreenChannel.fits')
 
 if __name__ == '__main__':
     main()